@@ -0,0 +1,523 @@
+"""
+Privileged broker calling systemd on behalf of the hub.
+
+The broker is a small process run as its own systemd service. The hub sends it
+requests over a Unix socket instead of forking systemctl and systemd-run from
+its own large process, and can then run unprivileged.
+
+The protocol is newline-delimited JSON. Each request has an id that is echoed
+in its response, so that requests can be pipelined over one connection and be
+answered out of order:
+
+    {"id": 1, "op": "service_running", "args": ["jupyter-a-singleuser"], "kwargs": {}}
+    {"id": 1, "result": true}
+    {"id": 2, "error": {"type": "TimeoutError", "message": "..."}}
+
+Concurrent service_running requests, as made when the hub polls many user
+servers, are batched into a single `systemctl is-active` call by the broker.
+
+Requests are only accepted from allowed users, and only for units named with
+one of the broker's unit prefixes. Units are only started with the properties
+SystemdSpawner sets, with NoNewPrivileges=, and as users in a range of uids
+that aren't members of privileged groups, so that access to the broker isn't
+equivalent to root.
+"""
+
+import argparse
+import asyncio
+import functools
+import grp
+import inspect
+import json
+import os
+import pwd
+import socket
+import struct
+
+from systemdspawner import systemd
+
+# functions of the systemd module the hub can request the broker to call
+OPERATIONS = [
+    "start_transient_service",
+    "set_service_properties",
+    "service_running",
+    "service_failed",
+    "service_properties",
+    "stop_service",
+    "reset_service",
+]
+
+# errors raised by the broker that are raised as the same type by the client
+ERRORS = {
+    "SystemdUnavailable": systemd.SystemdUnavailable,
+    "TimeoutError": TimeoutError,
+    "FileNotFoundError": FileNotFoundError,
+    "PermissionError": PermissionError,
+}
+
+# prefixes of the names of units the broker manages by default, matching the
+# default unit_name_template
+DEFAULT_UNIT_PREFIXES = ("jupyter-",)
+
+# operations only reading the state of a unit, which can also be requested for
+# slices, such as the slice of the user servers
+READ_ONLY_OPERATIONS = {"service_running", "service_failed", "service_properties"}
+
+# properties of units started by SystemdSpawner, the only properties the
+# broker starts units with apart from those given with --allowed-property
+#
+# ref: https://www.freedesktop.org/software/systemd/man/systemd.exec.html
+# ref: https://www.freedesktop.org/software/systemd/man/systemd.resource-control.html
+#
+ALLOWED_PROPERTIES = {
+    "BindReadOnlyPaths",
+    "CPUAccounting",
+    "CPUQuota",
+    "CPUWeight",
+    "DynamicUser",
+    "ExtensionImages",
+    "IOAccounting",
+    "IODeviceLatencyTargetSec",
+    "IOReadBandwidthMax",
+    "IOReadIOPSMax",
+    "IOWriteBandwidthMax",
+    "IOWriteIOPSMax",
+    "LogLevelMax",
+    "LogNamespace",
+    "LogRateLimitBurst",
+    "LogRateLimitIntervalSec",
+    "ManagedOOMMemoryPressure",
+    "ManagedOOMMemoryPressureLimit",
+    "MemoryAccounting",
+    "MemoryHigh",
+    "MemoryLow",
+    "MemoryMax",
+    "MemoryMin",
+    "MemorySwapMax",
+    "MountImages",
+    "NoNewPrivileges",
+    "PrivateDevices",
+    "PrivateTmp",
+    "ReadOnlyDirectories",
+    "ReadWriteDirectories",
+    "StateDirectory",
+    "TemporaryFileSystem",
+}
+
+# uids of users the broker starts units as by default, from the first uid of
+# regular users up to below the uids of systemd's dynamic users
+#
+# ref: https://systemd.io/UIDS-GIDS/
+#
+DEFAULT_UID_RANGE = (1000, 60000)
+
+# groups whose members can become root or read privileged data, which users
+# the broker starts units as mustn't be members of, in addition to root
+PRIVILEGED_GROUPS = [
+    "adm",
+    "disk",
+    "docker",
+    "kmem",
+    "lxd",
+    "shadow",
+    "sudo",
+    "systemd-journal",
+    "wheel",
+]
+
+
+def group_ids(group_names):
+    """
+    Return the gids of the groups that exist with given names, and of root.
+    """
+    gids = {0}
+    for name in group_names:
+        try:
+            gids.add(grp.getgrnam(name).gr_gid)
+        except KeyError:
+            pass
+    return gids
+
+
+# seconds the broker waits for more service_running requests to batch together
+BATCH_DELAY = 0.01
+
+# seconds the client waits for a response, longer than the broker's deadlines
+# for stopping a unit with retries
+REQUEST_TIMEOUT = (systemd.RETRIES + 1) * systemd.STOP_TIMEOUT + 30
+
+
+class BrokerError(RuntimeError):
+    """
+    Raised by the client for errors in the broker not in ERRORS.
+    """
+
+
+class Broker:
+    """
+    Serve requests from the hub, calling the functions of systemd_module.
+
+    systemd_module defaults to the systemd module, and can be replaced with a
+    fake providing the same functions for testing. Only peers with a uid in
+    allowed_uids may connect, and only units with a name starting with one of
+    unit_prefixes can be managed. Units are started as users with a uid in
+    uid_range, that aren't members of the groups with privileged_gids, and
+    with properties in allowed_properties.
+    """
+
+    def __init__(
+        self,
+        systemd_module=systemd,
+        allowed_uids=(),
+        unit_prefixes=DEFAULT_UNIT_PREFIXES,
+        uid_range=DEFAULT_UID_RANGE,
+        privileged_gids=None,
+        allowed_properties=ALLOWED_PROPERTIES,
+    ):
+        self.systemd = systemd_module
+        self.allowed_uids = set(allowed_uids)
+        self.unit_prefixes = tuple(unit_prefixes)
+        self.uid_range = uid_range
+        if privileged_gids is None:
+            privileged_gids = group_ids(PRIVILEGED_GROUPS)
+        self.privileged_gids = set(privileged_gids) | {0}
+        self.allowed_properties = set(allowed_properties)
+        self.operations = {name: getattr(systemd_module, name) for name in OPERATIONS}
+        self.operations["service_running"] = self.service_running
+        # unit name -> futures of service_running requests waiting for a batch
+        self._running_batch = {}
+        self._running_flush = None
+
+    async def service_running(self, unit_name):
+        """
+        Return true if service with given name is running, batching concurrent
+        requests into one call of services_running.
+        """
+        future = asyncio.get_running_loop().create_future()
+        self._running_batch.setdefault(unit_name, []).append(future)
+        if self._running_flush is None:
+            self._running_flush = asyncio.ensure_future(self._flush_running())
+        return await future
+
+    async def _flush_running(self):
+        await asyncio.sleep(BATCH_DELAY)
+        batch, self._running_batch = self._running_batch, {}
+        self._running_flush = None
+        try:
+            running = await self.systemd.services_running(list(batch))
+        except Exception as e:
+            for futures in batch.values():
+                for future in futures:
+                    if not future.done():
+                        future.set_exception(e)
+            return
+        for unit_name, futures in batch.items():
+            for future in futures:
+                if not future.done():
+                    future.set_result(running.get(unit_name, False))
+
+    def _peer_allowed(self, writer):
+        sock = writer.get_extra_info("socket")
+        creds = sock.getsockopt(
+            socket.SOL_SOCKET, socket.SO_PEERCRED, struct.calcsize("3i")
+        )
+        _, uid, _ = struct.unpack("3i", creds)
+        return uid in self.allowed_uids
+
+    async def handle_connection(self, reader, writer):
+        if not self._peer_allowed(writer):
+            writer.close()
+            return
+        tasks = set()
+        try:
+            while line := await reader.readline():
+                # handled concurrently, so pipelined requests don't wait for
+                # slower requests before them
+                task = asyncio.ensure_future(self.handle_request(line, writer))
+                tasks.add(task)
+                task.add_done_callback(tasks.discard)
+        finally:
+            # let requests such as starting a unit complete, even if the hub
+            # has gone away
+            await asyncio.gather(*tasks, return_exceptions=True)
+            writer.close()
+
+    async def handle_request(self, line, writer):
+        response = {}
+        try:
+            request = json.loads(line)
+            response["id"] = request["id"]
+            if request["op"] not in self.operations:
+                raise ValueError(f"Unknown operation {request['op']}")
+            arguments = self.check_request(
+                request["op"], request.get("args", []), request.get("kwargs", {})
+            )
+            operation = self.operations[request["op"]]
+            response["result"] = await operation(*arguments.args, **arguments.kwargs)
+        except Exception as e:
+            response["error"] = {"type": type(e).__name__, "message": str(e)}
+        writer.write(json.dumps(response).encode("utf8") + b"\n")
+        try:
+            await writer.drain()
+        except ConnectionError:
+            pass
+
+    def check_request(self, op, args, kwargs):
+        """
+        Return the arguments of a request bound to the signature of op, with
+        NoNewPrivileges= set on units started. Raise PermissionError if the
+        request isn't allowed.
+        """
+        # bound to the signature of the systemd module's function, as the
+        # fake of tests may not have the same signature
+        arguments = inspect.signature(getattr(systemd, op)).bind(*args, **kwargs)
+        unit_name = arguments.arguments["unit_name"]
+        if "/" in unit_name or not (
+            unit_name.startswith(self.unit_prefixes)
+            or (op in READ_ONLY_OPERATIONS and unit_name.endswith(".slice"))
+        ):
+            raise PermissionError(
+                f"Unit {unit_name} isn't named with one of the prefixes {', '.join(self.unit_prefixes)}"
+            )
+        if op == "set_service_properties":
+            self._check_properties(arguments.arguments["properties"])
+        elif op == "start_transient_service":
+            properties = dict(arguments.arguments.get("properties") or {})
+            self._check_user(arguments.arguments, properties)
+            # User= is checked for dynamic users
+            self._check_properties({k: v for k, v in properties.items() if k != "User"})
+            # setuid and setgid executables, such as sudo, can't gain
+            # privileges in the unit
+            #
+            # ref: https://www.freedesktop.org/software/systemd/man/systemd.exec.html#NoNewPrivileges=
+            #
+            properties["NoNewPrivileges"] = "yes"
+            arguments.arguments["properties"] = properties
+        return arguments
+
+    def _check_properties(self, properties):
+        denied = sorted(key for key in properties if key not in self.allowed_properties)
+        if denied:
+            raise PermissionError(
+                f"Properties {', '.join(denied)} aren't allowed by the broker"
+            )
+
+    def _check_user(self, arguments, properties):
+        """
+        Raise PermissionError unless a service is started as a dynamic user
+        named with one of the unit prefixes, or as a user with a uid in
+        uid_range that isn't a member of a privileged group.
+        """
+        uid = arguments.get("uid")
+        gid = arguments.get("gid")
+        if properties.get("DynamicUser") == "yes":
+            # an existing static user named by User= would be used instead of
+            # a dynamic user, so it must be named like the units
+            user = properties.get("User", arguments["unit_name"])
+            if not str(user).startswith(self.unit_prefixes):
+                raise PermissionError(
+                    f"Dynamic user {user} isn't named with one of the prefixes {', '.join(self.unit_prefixes)}"
+                )
+            if uid is not None or gid is not None:
+                raise PermissionError(
+                    "Dynamic users can't be started with a uid or gid"
+                )
+            return
+        if "User" in properties:
+            raise PermissionError("User= is only allowed with DynamicUser=yes")
+        if uid is None:
+            raise PermissionError(
+                f"Unit {arguments['unit_name']} would run as root, as it has no uid or DynamicUser="
+            )
+
+        first_uid, last_uid = self.uid_range
+        if not first_uid <= int(uid) <= last_uid:
+            raise PermissionError(
+                f"uid {uid} isn't in the range {first_uid}-{last_uid} allowed by the broker"
+            )
+        try:
+            pw = pwd.getpwuid(int(uid))
+        except KeyError:
+            raise PermissionError(f"No user with uid {uid}")
+        gid = pw.pw_gid if gid is None else int(gid)
+        privileged = self.privileged_gids.intersection(os.getgrouplist(pw.pw_name, gid))
+        if privileged:
+            raise PermissionError(
+                f"User {pw.pw_name} is a member of privileged groups with gids {', '.join(map(str, sorted(privileged)))}"
+            )
+
+
+async def serve(socket_path, socket_group=None, **broker_options):
+    """
+    Serve a Broker created with broker_options on a Unix socket at
+    socket_path, until cancelled.
+    """
+    broker = Broker(**broker_options)
+    if os.path.exists(socket_path):
+        os.unlink(socket_path)
+    server = await asyncio.start_unix_server(broker.handle_connection, socket_path)
+    os.chmod(socket_path, 0o660)
+    if socket_group:
+        os.chown(socket_path, -1, grp.getgrnam(socket_group).gr_gid)
+    async with server:
+        await server.serve_forever()
+
+
+class BrokerClient:
+    """
+    Client of a broker, providing the functions of the systemd module listed in
+    OPERATIONS as async methods. Requests of concurrent callers are pipelined
+    over one connection.
+
+    Must be created from the asyncio event loop it is used from.
+
+    If the broker can't be reached, SystemdUnavailable is raised like when
+    systemd itself is unhealthy.
+    """
+
+    def __init__(self, socket_path):
+        self.socket_path = socket_path
+        self._next_id = 0
+        # request id -> future of its response
+        self._pending = {}
+        self._writer = None
+        self._connect_lock = asyncio.Lock()
+        self._loop = asyncio.get_running_loop()
+
+    def __getattr__(self, name):
+        if name not in OPERATIONS:
+            raise AttributeError(name)
+        return functools.partial(self.request, name)
+
+    async def _connect(self):
+        async with self._connect_lock:
+            if self._writer is None:
+                try:
+                    reader, writer = await asyncio.open_unix_connection(
+                        self.socket_path
+                    )
+                except OSError as e:
+                    raise systemd.SystemdUnavailable(
+                        f"Broker at {self.socket_path} can't be reached: {e}"
+                    )
+                self._writer = writer
+                asyncio.ensure_future(self._read_responses(reader, writer))
+        return self._writer
+
+    async def _read_responses(self, reader, writer):
+        try:
+            while line := await reader.readline():
+                response = json.loads(line)
+                future = self._pending.pop(response["id"], None)
+                if future is not None and not future.done():
+                    future.set_result(response)
+        except ConnectionError:
+            pass
+        finally:
+            # reconnect on the next request, and fail those left unanswered
+            self._writer = None
+            writer.close()
+            pending, self._pending = self._pending, {}
+            for future in pending.values():
+                if not future.done():
+                    future.set_exception(
+                        systemd.SystemdUnavailable("Connection to broker lost")
+                    )
+
+    async def request(self, op, *args, **kwargs):
+        """
+        Request the broker to call the function op of the systemd module with
+        given arguments, and return its result.
+        """
+        writer = await self._connect()
+        self._next_id += 1
+        request_id = self._next_id
+        future = self._loop.create_future()
+        self._pending[request_id] = future
+        request = {"id": request_id, "op": op, "args": args, "kwargs": kwargs}
+        writer.write(json.dumps(request).encode("utf8") + b"\n")
+        try:
+            await writer.drain()
+            response = await asyncio.wait_for(future, REQUEST_TIMEOUT)
+        except asyncio.TimeoutError:
+            raise TimeoutError(f"Broker didn't respond to {op} in {REQUEST_TIMEOUT}s")
+        except ConnectionError as e:
+            raise systemd.SystemdUnavailable(f"Connection to broker lost: {e}")
+        finally:
+            self._pending.pop(request_id, None)
+
+        if "error" in response:
+            error = response["error"]
+            raise ERRORS.get(error["type"], BrokerError)(error["message"])
+        return response["result"]
+
+
+_clients = {}
+
+
+def get_client(socket_path):
+    """
+    Return a BrokerClient for socket_path, shared by all spawners.
+    """
+    client = _clients.get(socket_path)
+    if client is None or client._loop is not asyncio.get_running_loop():
+        client = _clients[socket_path] = BrokerClient(socket_path)
+    return client
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.split("\n\n")[0])
+    parser.add_argument("--socket", required=True, help="Unix socket to listen on")
+    parser.add_argument(
+        "--allowed-user",
+        action="append",
+        required=True,
+        help="User allowed to connect, such as the hub's user. Can be given multiple times.",
+    )
+    parser.add_argument(
+        "--socket-group", help="Group owning the socket, such as the hub's group"
+    )
+    parser.add_argument(
+        "--unit-prefix",
+        action="append",
+        help=f"Prefix of the names of units that can be managed, matching unit_name_template. Can be given multiple times. Defaults to {', '.join(DEFAULT_UNIT_PREFIXES)}",
+    )
+    parser.add_argument(
+        "--min-uid",
+        type=int,
+        default=DEFAULT_UID_RANGE[0],
+        help="Lowest uid of users units can be started as",
+    )
+    parser.add_argument(
+        "--max-uid",
+        type=int,
+        default=DEFAULT_UID_RANGE[1],
+        help="Highest uid of users units can be started as",
+    )
+    parser.add_argument(
+        "--privileged-group",
+        action="append",
+        help=f"Group whose members units can't be started as. Can be given multiple times. Defaults to {', '.join(PRIVILEGED_GROUPS)}",
+    )
+    parser.add_argument(
+        "--allowed-property",
+        action="append",
+        default=[],
+        help="Unit property allowed in addition to those set by SystemdSpawner, such as from unit_extra_properties. Can be given multiple times.",
+    )
+    args = parser.parse_args()
+    asyncio.run(
+        serve(
+            args.socket,
+            args.socket_group,
+            allowed_uids={pwd.getpwnam(user).pw_uid for user in args.allowed_user},
+            unit_prefixes=args.unit_prefix or DEFAULT_UNIT_PREFIXES,
+            uid_range=(args.min_uid, args.max_uid),
+            privileged_gids=group_ids(args.privileged_group or PRIVILEGED_GROUPS),
+            allowed_properties=ALLOWED_PROPERTIES | set(args.allowed_property),
+        )
+    )
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,267 @@
+"""
+Systemd and kernel capability probing.
+
+Capabilities are probed once per hub process without blocking the event loop,
+and are persisted to disk keyed by the boot ID, so that a restarted hub only
+probes again after the machine has rebooted. If systemd's version can't be
+probed, for example as systemctl timed out, the capabilities aren't persisted
+and are probed again after REPROBE_INTERVAL.
+
+Probably not very useful outside this spawner.
+"""
+
+import asyncio
+import glob
+import gzip
+import json
+import os
+import time
+import warnings
+
+from systemdspawner import systemd
+from systemdspawner.cgroups import CGROUP_ROOT
+
+BOOT_ID_PATH = "/proc/sys/kernel/random/boot_id"
+
+# bumped when probes are added or changed, to invalidate persisted results
+CAPABILITIES_VERSION = 1
+
+# systemd version that introduced DynamicUser=
+DYNAMIC_USER_SYSTEMD_VERSION = 235
+
+# seconds before capabilities are probed again if systemd's version is unknown
+REPROBE_INTERVAL = 60
+
+# result of the first complete probe in this process, and the task running it
+_capabilities = None
+_probe_task = None
+
+# (time.monotonic() of probe, result) of the last probe with an unknown systemd
+# version
+_incomplete = None
+
+
+async def probe_systemd_version():
+    """
+    Returns systemd's major version, or None if failing to do so.
+    """
+    try:
+        _, version_response = await systemd.run_systemd_command(
+            "version",
+            ["systemctl", "--version"],
+            systemd.QUERY_TIMEOUT,
+            retries=systemd.RETRIES,
+            stdout=asyncio.subprocess.PIPE,
+        )
+    except Exception as e:
+        warnings.warn(
+            f"Failed to run `systemctl --version` to get systemd version: {e}",
+            RuntimeWarning,
+        )
+        return None
+    return systemd.parse_systemd_version(version_response)
+
+
+def read_kernel_config():
+    """
+    Return the set of enabled options of the running kernel's config, or None
+    if it can't be found. Looks in the same places as check-kernel.bash.
+    """
+    release = os.uname().release
+    for path in [
+        "/proc/config.gz",
+        f"/boot/config-{release}",
+        f"/usr/src/linux-{release}/.config",
+        "/usr/src/linux/.config",
+    ]:
+        if not os.path.exists(path):
+            continue
+        opener = gzip.open if path.endswith(".gz") else open
+        with opener(path, "rt") as f:
+            return {
+                line.split("=")[0] for line in f if line.rstrip().endswith(("=y", "=m"))
+            }
+    return None
+
+
+def probe_cgroups():
+    """
+    Return the cgroup hierarchy version, and the set of available controllers.
+    """
+    unified_controllers = os.path.join(CGROUP_ROOT, "cgroup.controllers")
+    if os.path.exists(unified_controllers):
+        with open(unified_controllers) as f:
+            return 2, set(f.read().split())
+
+    # cgroup v1 or hybrid, where /proc/cgroups lists the enabled controllers
+    controllers = set()
+    with open("/proc/cgroups") as f:
+        for line in f:
+            if line.startswith("#"):
+                continue
+            name, _, _, enabled = line.split()
+            if enabled == "1":
+                controllers.add(name)
+    return 1, controllers
+
+
+def probe_kernel(systemd_version):
+    """
+    Return capabilities of the running kernel and its cgroups.
+    """
+    kernel_config = read_kernel_config()
+    try:
+        cgroup_version, controllers = probe_cgroups()
+    except OSError:
+        cgroup_version, controllers = None, set()
+
+    # CPUQuota requires CONFIG_CFS_BANDWIDTH, otherwise it has no effect
+    #
+    # ref: https://github.com/systemd/systemd/blob/v245/README#L35
+    #
+    if kernel_config is not None:
+        cfs_bandwidth = "CONFIG_CFS_BANDWIDTH" in kernel_config
+    elif cgroup_version == 2:
+        cfs_bandwidth = bool(glob.glob(os.path.join(CGROUP_ROOT, "*", "cpu.max")))
+    elif cgroup_version == 1:
+        cfs_bandwidth = os.path.exists(
+            os.path.join(CGROUP_ROOT, "cpu", "cpu.cfs_quota_us")
+        )
+    else:
+        cfs_bandwidth = None
+
+    if cgroup_version == 2:
+        freezer = bool(glob.glob(os.path.join(CGROUP_ROOT, "*", "cgroup.freeze")))
+    else:
+        freezer = "freezer" in controllers
+
+    return {
+        "systemd_version": systemd_version,
+        "cgroup_version": cgroup_version,
+        "cgroup_controllers": sorted(controllers),
+        "cpu_quota": cfs_bandwidth,
+        "memory_limit": "memory" in controllers,
+        "freezer": freezer,
+        "pressure": os.path.exists("/proc/pressure/memory"),
+        # None if unknown
+        "dynamic_user": (
+            None
+            if systemd_version is None
+            else systemd_version >= DYNAMIC_USER_SYSTEMD_VERSION
+        ),
+    }
+
+
+def read_boot_id():
+    with open(BOOT_ID_PATH) as f:
+        return f.read().strip()
+
+
+def load_capabilities(cache_path, boot_id):
+    """
+    Return capabilities persisted for the given boot ID, or None.
+    """
+    try:
+        with open(cache_path) as f:
+            cache = json.load(f)
+    except (OSError, ValueError):
+        return None
+    if cache.get("boot_id") != boot_id or cache.get("version") != CAPABILITIES_VERSION:
+        return None
+    return cache["capabilities"]
+
+
+def save_capabilities(cache_path, boot_id, capabilities):
+    """
+    Persist capabilities for the given boot ID, warning on failure.
+    """
+    cache = {
+        "boot_id": boot_id,
+        "version": CAPABILITIES_VERSION,
+        "capabilities": capabilities,
+    }
+    try:
+        os.makedirs(os.path.dirname(cache_path), exist_ok=True)
+        tmp_path = f"{cache_path}.tmp"
+        with open(tmp_path, "w") as f:
+            json.dump(cache, f)
+        os.replace(tmp_path, cache_path)
+    except OSError as e:
+        warnings.warn(
+            f"Failed to persist systemd capabilities to {cache_path}: {e}",
+            RuntimeWarning,
+        )
+
+
+async def probe(cache_path=None):
+    """
+    Probe capabilities, or load them from cache_path if they have been probed
+    before since the machine booted.
+    """
+    boot_id = None
+    if cache_path:
+        try:
+            boot_id = await asyncio.to_thread(read_boot_id)
+        except OSError:
+            pass
+        else:
+            capabilities = await asyncio.to_thread(
+                load_capabilities, cache_path, boot_id
+            )
+            if capabilities is not None:
+                return capabilities
+
+    systemd_version = await probe_systemd_version()
+    capabilities = await asyncio.to_thread(probe_kernel, systemd_version)
+
+    # not persisted if systemd's version is unknown, so that a transient
+    # failure isn't remembered until the next boot
+    if cache_path and boot_id and systemd_version is not None:
+        await asyncio.to_thread(save_capabilities, cache_path, boot_id, capabilities)
+    return capabilities
+
+
+def _reprobe_pending():
+    """
+    Return True if the last probe had an unknown systemd version, and it isn't
+    yet time to probe again.
+    """
+    return (
+        _incomplete is not None and time.monotonic() - _incomplete[0] < REPROBE_INTERVAL
+    )
+
+
+def start_probe(cache_path=None):
+    """
+    Start probing capabilities in the background, unless they have already
+    been probed or are being probed.
+    """
+    global _probe_task
+    if _capabilities is not None or _reprobe_pending():
+        return
+    loop = asyncio.get_running_loop()
+    if _probe_task is None or _probe_task.get_loop() is not loop:
+        _probe_task = loop.create_task(probe(cache_path))
+
+
+async def get_capabilities(cache_path=None):
+    """
+    Return the capabilities of this machine, probing them only on first use
+    in this process. Concurrent callers share the same probe.
+    """
+    global _capabilities, _incomplete, _probe_task
+    if _capabilities is not None:
+        return _capabilities
+    if _reprobe_pending():
+        return _incomplete[1]
+    start_probe(cache_path)
+    try:
+        capabilities = await asyncio.shield(_probe_task)
+    finally:
+        if _probe_task is not None and _probe_task.done():
+            _probe_task = None
+    if capabilities["systemd_version"] is None:
+        _incomplete = (time.monotonic(), capabilities)
+    else:
+        _capabilities = capabilities
+    return capabilities
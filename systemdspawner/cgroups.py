@@ -0,0 +1,131 @@
+"""
+Cgroup utilities.
+
+Contains functions to read cgroup v2 interface files of units, and to watch
+them for changes with inotify.
+Probably not very useful outside this spawner.
+"""
+
+import asyncio
+import ctypes
+import os
+import struct
+
+CGROUP_ROOT = "/sys/fs/cgroup"
+PROC_PRESSURE_ROOT = "/proc/pressure"
+
+# ref: https://man7.org/linux/man-pages/man7/inotify.7.html
+IN_MODIFY = 0x00000002
+IN_IGNORED = 0x00008000
+INOTIFY_EVENT = struct.Struct("iIII")
+
+
+def cgroup_path(control_group, filename=None):
+    """
+    Return the path of a cgroup, as given by a unit's ControlGroup property,
+    or of one of its interface files.
+    """
+    path = os.path.join(CGROUP_ROOT, control_group.lstrip("/"))
+    if filename:
+        path = os.path.join(path, filename)
+    return path
+
+
+def read_flat_keyed(path):
+    """
+    Read a cgroup interface file with `KEY VALUE` lines, such as memory.events,
+    into a dict of integers.
+
+    ref: https://docs.kernel.org/admin-guide/cgroup-v2.html#interface-files
+    """
+    with open(path) as f:
+        return {key: int(value) for key, value in (line.split() for line in f)}
+
+
+def read_pressure(path):
+    """
+    Read a pressure stall information (PSI) file, such as /proc/pressure/cpu or
+    a cgroup's memory.pressure, into a dict like {"some": {"avg10": 1.5, ...},
+    "full": {...}}.
+
+    ref: https://docs.kernel.org/accounting/psi.html
+    """
+    pressure = {}
+    with open(path) as f:
+        for line in f:
+            kind, *fields = line.split()
+            pressure[kind] = {
+                key: float(value) for key, value in (x.split("=") for x in fields)
+            }
+    return pressure
+
+
+class InotifyWatcher:
+    """
+    Watch files for modifications with inotify, calling a callback for each
+    modification from the asyncio event loop.
+
+    Cgroup v2 interface files such as memory.events generate modification
+    events when their content changes, so they can be watched without polling.
+    """
+
+    def __init__(self):
+        self._libc = ctypes.CDLL(None, use_errno=True)
+        self._fd = self._libc.inotify_init1(os.O_NONBLOCK | os.O_CLOEXEC)
+        if self._fd < 0:
+            errno = ctypes.get_errno()
+            raise OSError(errno, os.strerror(errno))
+        # watch descriptor -> callback
+        self._callbacks = {}
+        self._loop = asyncio.get_running_loop()
+        self._loop.add_reader(self._fd, self._read_events)
+
+    def watch(self, path, callback):
+        """
+        Call callback() whenever the file at path is modified, and return a
+        watch descriptor to pass to unwatch.
+        """
+        wd = self._libc.inotify_add_watch(self._fd, os.fsencode(path), IN_MODIFY)
+        if wd < 0:
+            errno = ctypes.get_errno()
+            raise OSError(errno, os.strerror(errno), path)
+        self._callbacks[wd] = callback
+        return wd
+
+    def unwatch(self, wd):
+        if self._callbacks.pop(wd, None) is not None:
+            # fails if the file has been removed, which removes the watch too
+            self._libc.inotify_rm_watch(self._fd, wd)
+
+    def _read_events(self):
+        try:
+            data = os.read(self._fd, 64 * 1024)
+        except BlockingIOError:
+            return
+        offset = 0
+        while offset < len(data):
+            wd, mask, _, name_len = INOTIFY_EVENT.unpack_from(data, offset)
+            offset += INOTIFY_EVENT.size + name_len
+            if mask & IN_IGNORED:
+                # the file was removed, such as when a unit's cgroup is removed
+                self._callbacks.pop(wd, None)
+            elif wd in self._callbacks:
+                self._callbacks[wd]()
+
+    def close(self):
+        self._loop.remove_reader(self._fd)
+        os.close(self._fd)
+        self._callbacks.clear()
+
+
+_watcher = None
+
+
+def get_watcher():
+    """
+    Return an InotifyWatcher shared by all spawners.
+    """
+    global _watcher
+    if _watcher is None or _watcher._loop is not asyncio.get_running_loop():
+        _watcher = InotifyWatcher()
+    return _watcher
@@ -0,0 +1,73 @@
+"""
+Prometheus metrics for SystemdSpawner.
+
+They are registered in prometheus_client's default registry, and are therefore
+exposed by JupyterHub's /metrics endpoint next to JupyterHub's own metrics.
+
+Read https://prometheus.io/docs/practices/naming/ for naming conventions for
+metrics & labels.
+"""
+
+from prometheus_client import Counter, Gauge, Histogram
+
+SYSTEMD_CALL_DURATION_SECONDS = Histogram(
+    "systemdspawner_systemd_call_duration_seconds",
+    "Time taken by calls to systemd, such as systemctl and systemd-run",
+    ["operation"],
+    buckets=[0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60, float("inf")],
+)
+
+SYSTEMD_CALL_FAILURES = Counter(
+    "systemdspawner_systemd_call_failures",
+    "Calls to systemd that failed, by reason (timeout, rejected, error)",
+    ["operation", "reason"],
+)
+
+SYSTEMD_CIRCUIT_BREAKER_OPEN = Gauge(
+    "systemdspawner_systemd_circuit_breaker_open",
+    "1 if calls to systemd are rejected as systemd seems unhealthy, else 0",
+)
+
+SERVER_READY_DURATION_SECONDS = Histogram(
+    "systemdspawner_server_ready_duration_seconds",
+    "Time from starting a user server until it responds to HTTP requests, by mode (service, zygote)",
+    ["mode"],
+    buckets=[0.25, 0.5, 1, 2, 3, 5, 7.5, 10, 15, 30, 60, float("inf")],
+)
+
+MEMORY_EVENTS = Counter(
+    "systemdspawner_memory_events",
+    "Memory events of user units, by memory.events key (oom, oom_kill, high, max, ...)",
+    ["event"],
+)
+
+PRESSURE = Gauge(
+    "systemdspawner_pressure",
+    "Pressure stall percentage (avg10) of the node or the spawner's slice, as last read when spawning or polling running servers",
+    ["scope", "resource", "kind"],
+)
+
+SPAWNS_DELAYED_BY_PRESSURE = Counter(
+    "systemdspawner_spawns_delayed_by_pressure",
+    "Spawns delayed, or rejected if outcome is rejected, as pressure was above spawn_pressure_thresholds",
+    ["outcome"],
+)
+
+LOG_NAMESPACE_MESSAGES = Counter(
+    "systemdspawner_log_namespace_messages",
+    "Messages logged to log namespaces of user units",
+    ["namespace"],
+)
+
+LOG_NAMESPACE_MESSAGE_BYTES = Counter(
+    "systemdspawner_log_namespace_message_bytes",
+    "Bytes of messages logged to log namespaces of user units",
+    ["namespace"],
+)
+
+HOME_SEEDING_DURATION_SECONDS = Histogram(
+    "systemdspawner_home_seeding_duration_seconds",
+    "Time taken to seed homes of dynamic users from home_template, by method (reflink, copy)",
+    ["method"],
+    buckets=[0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60, 120, 300, float("inf")],
+)
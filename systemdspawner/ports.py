@@ -0,0 +1,80 @@
+"""
+Port allocation for user servers.
+
+Ports are reserved in the hub process from when a user server is started until
+it is stopped, so concurrent spawns never pick the same port. Picking ports
+with jupyterhub.utils.random_port alone only ensures a port is free when it is
+picked, not when the user server binds it.
+Probably not very useful outside this spawner.
+"""
+
+import socket
+
+from jupyterhub.utils import random_port
+
+# attempts to pick a random port that isn't reserved
+RANDOM_PORT_ATTEMPTS = 100
+
+
+def port_free(port):
+    """
+    Return true if nothing is listening on port.
+    """
+    with socket.socket(socket.AF_INET, socket.SOCK_STREAM) as s:
+        try:
+            s.bind(("", port))
+        except OSError:
+            return False
+    return True
+
+
+class PortAllocator:
+    """
+    Allocate ports for user servers, from a range of ports if given or from
+    the ephemeral ports picked by the OS otherwise.
+    """
+
+    def __init__(self):
+        self.reserved = set()
+        # port after the last one allocated from a range, so that recently
+        # released ports aren't reused right away
+        self._next_port = None
+
+    def allocate(self, port_range=None):
+        """
+        Reserve and return a free port, within port_range (first, last) if
+        given. Raises RuntimeError if no port is available.
+        """
+        if port_range:
+            first, last = port_range
+            start = (
+                self._next_port if self._next_port in range(first, last + 1) else first
+            )
+            candidates = [*range(start, last + 1), *range(first, start)]
+            for port in candidates:
+                if port not in self.reserved and port_free(port):
+                    self.reserved.add(port)
+                    self._next_port = port + 1
+                    return port
+            raise RuntimeError(f"No free port left in port_range {first}-{last}")
+
+        for i in range(RANDOM_PORT_ATTEMPTS):
+            port = random_port()
+            if port not in self.reserved:
+                self.reserved.add(port)
+                return port
+        raise RuntimeError("Failed to pick a free port")
+
+    def reserve(self, port):
+        """
+        Reserve a port allocated before, such as one loaded from a spawner's
+        state after the hub restarted.
+        """
+        self.reserved.add(port)
+
+    def release(self, port):
+        self.reserved.discard(port)
+
+
+# shared by all spawners of the hub
+allocator = PortAllocator()
@@ -0,0 +1,280 @@
+"""
+Pre-spawn user servers ahead of scheduled peak times.
+
+Runs as a JupyterHub service, and starts the servers of a group's users ahead
+of each time in a schedule given in systemd's OnCalendar syntax, such as when
+a lecture starts. Servers are started through the hub's REST API at a throttled
+rate, with the user option "prespawned" set. Servers not used by their user by
+the end of a grace period are stopped again.
+
+The hit rate (share of pre-spawned servers used) and the time unused servers
+ran are logged and exposed as Prometheus metrics.
+
+The schedule is a JSON list of entries like:
+
+    {
+        "group": "physics-101",
+        "calendar": "Mon,Wed *-*-* 10:00",
+        "lead_time": 600,
+        "grace_period": 900
+    }
+
+where lead_time and grace_period are seconds before and after each time.
+"""
+
+import argparse
+import asyncio
+import json
+import logging
+import os
+import time
+from datetime import datetime, timezone
+from urllib.parse import quote
+
+from prometheus_client import Counter, start_http_server
+from tornado.httpclient import AsyncHTTPClient, HTTPClientError, HTTPRequest
+
+log = logging.getLogger("systemdspawner.prespawn")
+
+# defaults of the schedule entries' lead_time and grace_period, in seconds
+DEFAULT_LEAD_TIME = 600
+DEFAULT_GRACE_PERIOD = 900
+
+# seconds of activity after a server started for it to count as used, as the
+# hub records activity when a server starts
+CLAIM_ACTIVITY_DELAY = 60
+
+# seconds to wait before retrying a start rejected by the hub's
+# concurrent_spawn_limit, if it doesn't send a Retry-After header
+SPAWN_LIMIT_RETRY_DELAY = 10
+
+PRESPAWNS = Counter(
+    "systemdspawner_prespawns",
+    "User servers pre-spawned, by schedule entry and outcome (claimed, unclaimed, stopped, failed)",
+    ["entry", "outcome"],
+)
+
+PRESPAWN_WASTED_SECONDS = Counter(
+    "systemdspawner_prespawn_wasted_seconds",
+    "Time pre-spawned user servers ran unused before being stopped, by schedule entry",
+    ["entry"],
+)
+
+
+def parse_calendar_elapse(output):
+    """
+    Return the next elapse from the output of `systemd-analyze calendar` as a
+    UTC timestamp, or None if the calendar doesn't elapse again.
+
+    ref: https://www.freedesktop.org/software/systemd/man/systemd-analyze.html#systemd-analyze%20calendar%20EXPRESSION...
+    """
+    times = {}
+    for line in output.splitlines():
+        key, _, value = line.strip().partition(": ")
+        times[key] = value.strip()
+    # "(in UTC)" is left out if the local timezone is UTC
+    value = times.get("(in UTC)") or times.get("Next elapse")
+    if not value or not value.endswith(" UTC"):
+        return None
+    elapse = datetime.strptime(value, "%a %Y-%m-%d %H:%M:%S UTC")
+    return elapse.replace(tzinfo=timezone.utc).timestamp()
+
+
+async def next_elapse(calendar):
+    """
+    Return the next time calendar elapses, in systemd's OnCalendar syntax, as a
+    UTC timestamp. Like for timers, times of the calendar are in the local
+    timezone unless the calendar gives a timezone.
+
+    ref: https://www.freedesktop.org/software/systemd/man/systemd.time.html#Calendar%20Events
+    """
+    proc = await asyncio.create_subprocess_exec(
+        "systemd-analyze",
+        "calendar",
+        calendar,
+        stdout=asyncio.subprocess.PIPE,
+    )
+    stdout, _ = await proc.communicate()
+    if proc.returncode != 0:
+        raise ValueError(f"Invalid calendar {calendar}")
+    return parse_calendar_elapse(stdout.decode("utf8", "replace"))
+
+
+def parse_time(timestamp):
+    """
+    Parse an ISO 8601 timestamp returned by the hub's REST API.
+    """
+    if not timestamp:
+        return None
+    return datetime.fromisoformat(timestamp.replace("Z", "+00:00"))
+
+
+class PreSpawner:
+    """
+    Pre-spawn user servers for schedule entries, using the hub's REST API.
+    """
+
+    def __init__(self, api_url, api_token, rate=1):
+        self.api_url = api_url.rstrip("/")
+        self.api_token = api_token
+        # user servers started per second
+        self.rate = rate
+
+    async def api_request(self, method, path, body=None):
+        request = HTTPRequest(
+            self.api_url + path,
+            method=method,
+            headers={"Authorization": f"token {self.api_token}"},
+            body=None if body is None else json.dumps(body),
+        )
+        response = await AsyncHTTPClient().fetch(request)
+        if response.body:
+            return json.loads(response.body)
+        return None
+
+    async def start_server(self, username):
+        path = f"/users/{quote(username, safe='')}/server"
+        while True:
+            try:
+                return await self.api_request("POST", path, {"prespawned": True})
+            except HTTPClientError as e:
+                if e.code != 429:
+                    raise
+                retry_after = (
+                    e.response.headers.get("Retry-After") if e.response else None
+                )
+                await asyncio.sleep(float(retry_after or SPAWN_LIMIT_RETRY_DELAY))
+
+    async def prespawn(self, entry):
+        """
+        Start the servers of the entry's group that aren't running yet, and
+        return the names of their users.
+        """
+        name = entry.get("name", entry["group"])
+        group = await self.api_request(
+            "GET", f"/groups/{quote(entry['group'], safe='')}"
+        )
+        prespawned = []
+        for username in group["users"]:
+            user = await self.api_request("GET", f"/users/{quote(username, safe='')}")
+            if user["servers"].get(""):
+                # already running or starting
+                continue
+            try:
+                await self.start_server(username)
+            except HTTPClientError as e:
+                log.warning("Failed to pre-spawn server of %s: %s", username, e)
+                PRESPAWNS.labels(name, "failed").inc()
+                continue
+            prespawned.append(username)
+            await asyncio.sleep(1 / self.rate)
+        log.info(
+            "Pre-spawned %i servers for %s, of %i users",
+            len(prespawned),
+            name,
+            len(group["users"]),
+        )
+        return prespawned
+
+    async def collect(self, entry, usernames):
+        """
+        Stop pre-spawned servers their users haven't used, and report the hit
+        rate and time wasted on unused servers. Returns the number of used
+        servers and the seconds unused servers ran.
+        """
+        name = entry.get("name", entry["group"])
+        claimed = 0
+        wasted_seconds = 0
+        now = datetime.now(timezone.utc)
+        for username in usernames:
+            user = await self.api_request("GET", f"/users/{quote(username, safe='')}")
+            server = user["servers"].get("")
+            if not server:
+                # stopped by the user, or an idle culler
+                PRESPAWNS.labels(name, "stopped").inc()
+                continue
+            started = parse_time(server["started"])
+            last_activity = parse_time(server["last_activity"])
+            if (
+                last_activity
+                and (last_activity - started).total_seconds() > CLAIM_ACTIVITY_DELAY
+            ):
+                claimed += 1
+                PRESPAWNS.labels(name, "claimed").inc()
+                continue
+            await self.api_request(
+                "DELETE", f"/users/{quote(username, safe='')}/server"
+            )
+            seconds = (now - started).total_seconds()
+            wasted_seconds += seconds
+            PRESPAWNS.labels(name, "unclaimed").inc()
+            PRESPAWN_WASTED_SECONDS.labels(name).inc(seconds)
+
+        log.info(
+            "%s: %i of %i pre-spawned servers used (hit rate %.0f%%), unused servers ran for %.0fs",
+            name,
+            claimed,
+            len(usernames),
+            100 * claimed / len(usernames) if usernames else 0,
+            wasted_seconds,
+        )
+        return claimed, wasted_seconds
+
+    async def run_entry(self, entry):
+        """
+        Pre-spawn servers ahead of each time the entry's calendar elapses.
+        """
+        lead_time = entry.get("lead_time", DEFAULT_LEAD_TIME)
+        grace_period = entry.get("grace_period", DEFAULT_GRACE_PERIOD)
+        while True:
+            elapse = await next_elapse(entry["calendar"])
+            if elapse is None:
+                log.info("Calendar %s doesn't elapse again", entry["calendar"])
+                return
+            await asyncio.sleep(max(elapse - lead_time - time.time(), 0))
+            try:
+                usernames = await self.prespawn(entry)
+                await asyncio.sleep(max(elapse + grace_period - time.time(), 0))
+                await self.collect(entry, usernames)
+            except Exception:
+                log.exception("Failed to pre-spawn servers for %s", entry)
+                # not to retry until the calendar elapses
+                await asyncio.sleep(max(elapse - time.time(), 0) + 1)
+
+    async def run(self, schedule):
+        await asyncio.gather(*(self.run_entry(entry) for entry in schedule))
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.split("\n\n")[0])
+    parser.add_argument(
+        "--schedule",
+        required=True,
+        help="Schedule as a JSON list of entries, or a path to one",
+    )
+    parser.add_argument(
+        "--rate", type=float, default=1, help="User servers to start per second"
+    )
+    parser.add_argument(
+        "--metrics-port", type=int, help="Port to serve Prometheus metrics on"
+    )
+    args = parser.parse_args()
+    logging.basicConfig(level=logging.INFO)
+
+    if args.schedule.lstrip().startswith("["):
+        schedule = json.loads(args.schedule)
+    else:
+        with open(args.schedule) as f:
+            schedule = json.load(f)
+    if args.metrics_port:
+        start_http_server(args.metrics_port)
+
+    # set by JupyterHub for the services it manages
+    prespawner = PreSpawner(
+        os.environ["JUPYTERHUB_API_URL"], os.environ["JUPYTERHUB_API_TOKEN"], args.rate
+    )
+    asyncio.run(prespawner.run(schedule))
+
+
+if __name__ == "__main__":
+    main()
@@ -7,18 +7,182 @@ Probably not very useful outside this spawner.
 
 import asyncio
 import functools
+import json
 import os
+import random
 import re
 import shlex
 import shutil
 import subprocess
+import time
 import warnings
 
+from systemdspawner.metrics import (
+    SYSTEMD_CALL_DURATION_SECONDS,
+    SYSTEMD_CALL_FAILURES,
+    SYSTEMD_CIRCUIT_BREAKER_OPEN,
+)
+
 # light validation of environment variable keys
 env_pat = re.compile("[A-Za-z_]+")
 
 RUN_ROOT = "/run"
 
+# prefixes of unit properties controlling resources, which unlike properties
+# configuring the execution environment can be set on scope units
+#
+# ref: https://www.freedesktop.org/software/systemd/man/systemd.resource-control.html
+#
+RESOURCE_CONTROL_PROPERTY_PREFIXES = (
+    "CPU",
+    "Memory",
+    "IO",
+    "Tasks",
+    "Startup",
+    "ManagedOOM",
+    "IP",
+    "Device",
+    "Delegate",
+    "Allowed",
+)
+
+# deadlines in seconds for calls to systemd, by kind of operation, after which
+# the call is killed and counted as a failure by the circuit breaker
+QUERY_TIMEOUT = 10
+START_TIMEOUT = 60
+# systemd waits up to TimeoutStopSec, 90 seconds by default, before killing
+STOP_TIMEOUT = 120
+
+# number of times idempotent calls are retried after timing out, with a random
+# delay of up to RETRY_BACKOFF * 2**attempt seconds
+RETRIES = 2
+RETRY_BACKOFF = 0.5
+
+
+class SystemdUnavailable(Exception):
+    """
+    Raised when a call to systemd is rejected without trying, as recent calls
+    have timed out and systemd is considered unhealthy.
+    """
+
+
+class CircuitBreaker:
+    """
+    Circuit breaker rejecting calls to systemd after consecutive failures.
+
+    After failure_threshold consecutive failures the breaker opens, and calls
+    are rejected for reset_timeout seconds. A single trial call is then let
+    through, and the breaker closes on its success, or re-opens on its
+    failure. Other calls are rejected meanwhile, so that they don't all hit an
+    overloaded systemd at once. A trial call that hasn't completed within
+    reset_timeout, such as one that was cancelled, is replaced by a new one,
+    and one that couldn't be run at all is replaced right away.
+    """
+
+    def __init__(self, failure_threshold=5, reset_timeout=30):
+        self.failure_threshold = failure_threshold
+        self.reset_timeout = reset_timeout
+        self.failures = 0
+        self.opened_at = None
+        # when the trial call in the half-open state was let through
+        self.trial_started = None
+
+    @property
+    def state(self):
+        if self.opened_at is None:
+            return "closed"
+        if time.monotonic() - self.opened_at < self.reset_timeout:
+            return "open"
+        return "half-open"
+
+    def allow(self):
+        state = self.state
+        if state != "half-open":
+            return state == "closed"
+        now = time.monotonic()
+        if (
+            self.trial_started is not None
+            and now - self.trial_started < self.reset_timeout
+        ):
+            return False
+        self.trial_started = now
+        return True
+
+    def record_success(self):
+        self.failures = 0
+        self.trial_started = None
+        if self.opened_at is not None:
+            self.opened_at = None
+            SYSTEMD_CIRCUIT_BREAKER_OPEN.set(0)
+
+    def record_failure(self):
+        self.failures += 1
+        if self.state == "half-open" or self.failures >= self.failure_threshold:
+            self.opened_at = time.monotonic()
+            SYSTEMD_CIRCUIT_BREAKER_OPEN.set(1)
+        self.trial_started = None
+
+    def abandon_trial(self):
+        # the call never reached systemd, so it says nothing about whether
+        # systemd has recovered
+        self.trial_started = None
+
+
+breaker = CircuitBreaker()
+
+
+async def run_systemd_command(
+    operation, cmd, timeout, retries=0, stdout=asyncio.subprocess.DEVNULL
+):
+    """
+    Run a command calling systemd, such as systemctl, and return its exit code
+    and captured stdout.
+
+    The command is killed if it doesn't complete within timeout seconds, and
+    is retried after a jittered delay if retries is set, which should only be
+    done for idempotent operations. Timeouts are recorded by the circuit
+    breaker, and when it is open the command isn't run at all.
+
+    Throws SystemdUnavailable if the circuit breaker is open, and TimeoutError
+    if the command timed out on all attempts.
+    """
+    for attempt in range(retries + 1):
+        if not breaker.allow():
+            SYSTEMD_CALL_FAILURES.labels(operation=operation, reason="rejected").inc()
+            raise SystemdUnavailable(
+                f"Not calling systemd to {operation}, as recent calls have timed out"
+            )
+        if attempt:
+            await asyncio.sleep(random.uniform(0, RETRY_BACKOFF * 2**attempt))
+
+        start = time.perf_counter()
+        try:
+            proc = await asyncio.create_subprocess_exec(*cmd, stdout=stdout)
+        except OSError:
+            breaker.abandon_trial()
+            SYSTEMD_CALL_FAILURES.labels(operation=operation, reason="error").inc()
+            raise
+        try:
+            output, _ = await asyncio.wait_for(proc.communicate(), timeout)
+        except asyncio.TimeoutError:
+            proc.kill()
+            await proc.wait()
+            breaker.record_failure()
+            SYSTEMD_CALL_FAILURES.labels(operation=operation, reason="timeout").inc()
+            continue
+        breaker.record_success()
+        SYSTEMD_CALL_DURATION_SECONDS.labels(operation=operation).observe(
+            time.perf_counter() - start
+        )
+        return proc.returncode, output
+
+    raise TimeoutError(f"Calling systemd to {operation} timed out after {timeout}s")
+
+
+# the longest journal line we read in one go when following a unit's journal,
+# the remainder of longer lines is discarded
+JOURNAL_LINE_LIMIT = 64 * 1024
+
 
 def ensure_environment_directory(environment_file_directory):
     """Ensure directory for environment files exists and is private"""
@@ -166,51 +330,297 @@ async def start_transient_service(
     # Append typical Spawner "cmd" and "args" on how to start the user server
     run_cmd += cmd + args
 
-    proc = await asyncio.create_subprocess_exec(*run_cmd)
+    # not retried, as systemd-run isn't idempotent
+    returncode, _ = await run_systemd_command(
+        "start", run_cmd, START_TIMEOUT, stdout=None
+    )
+    return returncode
+
+
+async def start_transient_scope(unit_name, pids, properties=None, slice=None):
+    """
+    Start a systemd transient scope unit containing already running processes,
+    and set given resource control properties on it.
 
-    return await proc.wait()
+    Unlike services, scopes only support resource control properties, see
+    RESOURCE_CONTROL_PROPERTY_PREFIXES.
+
+    Throws CalledProcessError if creating the scope or setting its properties
+    fails.
+
+    ref: https://www.freedesktop.org/software/systemd/man/systemd.scope.html
+    ref: https://www.freedesktop.org/wiki/Software/systemd/dbus/ (StartTransientUnit)
+    """
+    # D-Bus (name, signature, value...) triples of the scope's properties
+    scope_properties = [("PIDs", "au", str(len(pids)), *(str(pid) for pid in pids))]
+    if slice:
+        scope_properties.append(("Slice", "s", slice))
+    create_cmd = [
+        "busctl",
+        "call",
+        "org.freedesktop.systemd1",
+        "/org/freedesktop/systemd1",
+        "org.freedesktop.systemd1.Manager",
+        "StartTransientUnit",
+        "ssa(sv)a(sa(sv))",
+        unit_name,
+        "fail",
+        str(len(scope_properties)),
+    ]
+    for scope_property in scope_properties:
+        create_cmd += scope_property
+    # no auxiliary units
+    create_cmd.append("0")
+    returncode, _ = await run_systemd_command("start-scope", create_cmd, START_TIMEOUT)
+    if returncode:
+        raise subprocess.CalledProcessError(returncode, create_cmd)
+
+    await set_service_properties(unit_name, properties or {})
+
+
+async def set_service_properties(unit_name, properties):
+    """
+    Set properties of a running unit with given name, until it is stopped.
+
+    Only resource control properties can be changed at runtime, see
+    RESOURCE_CONTROL_PROPERTY_PREFIXES.
+
+    Throws CalledProcessError if setting the properties fails.
+    """
+    # set-property understands the same property syntax as systemd-run, which
+    # saves us from converting each property into its D-Bus type
+    property_args = []
+    for key, value in properties.items():
+        if isinstance(value, list):
+            property_args += [f"{key}={v}" for v in value]
+        else:
+            property_args.append(f"{key}={value}")
+    if not property_args:
+        return
+    set_property_cmd = [
+        "systemctl",
+        "set-property",
+        "--runtime",
+        unit_name,
+        *property_args,
+    ]
+    returncode, _ = await run_systemd_command(
+        "set-property", set_property_cmd, QUERY_TIMEOUT, retries=RETRIES
+    )
+    if returncode:
+        raise subprocess.CalledProcessError(returncode, set_property_cmd)
 
 
 async def service_running(unit_name):
     """
     Return true if service with given name is running (active).
     """
-    proc = await asyncio.create_subprocess_exec(
-        "systemctl",
+    # hide stdout, but don't capture stderr at all
+    ret, _ = await run_systemd_command(
         "is-active",
-        unit_name,
-        # hide stdout, but don't capture stderr at all
-        stdout=asyncio.subprocess.DEVNULL,
+        ["systemctl", "is-active", unit_name],
+        QUERY_TIMEOUT,
+        retries=RETRIES,
     )
-    ret = await proc.wait()
 
     return ret == 0
 
 
+async def services_running(unit_names):
+    """
+    Return a dict of which of the services with given names are running
+    (active), querying systemd only once.
+    """
+    _, stdout = await run_systemd_command(
+        "is-active",
+        ["systemctl", "is-active", *unit_names],
+        QUERY_TIMEOUT,
+        retries=RETRIES,
+        stdout=asyncio.subprocess.PIPE,
+    )
+    # one state per unit is printed, in the order of the given units
+    states = stdout.decode("utf8", "replace").split()
+    return {
+        unit_name: state == "active" for unit_name, state in zip(unit_names, states)
+    }
+
+
 async def service_failed(unit_name):
     """
     Return true if service with given name is in a failed state.
     """
-    proc = await asyncio.create_subprocess_exec(
-        "systemctl",
+    # hide stdout, but don't capture stderr at all
+    ret, _ = await run_systemd_command(
         "is-failed",
-        unit_name,
-        # hide stdout, but don't capture stderr at all
-        stdout=asyncio.subprocess.DEVNULL,
+        ["systemctl", "is-failed", unit_name],
+        QUERY_TIMEOUT,
+        retries=RETRIES,
     )
-    ret = await proc.wait()
 
     return ret == 0
 
 
+async def service_properties(unit_name, *names):
+    """
+    Return a dict with the given properties of the unit with given name, as
+    reported by `systemctl show`.
+
+    ref: https://www.freedesktop.org/software/systemd/man/systemctl.html#show%20PATTERN%E2%80%A6%7CJOB%E2%80%A6
+    """
+    _, stdout = await run_systemd_command(
+        "show",
+        ["systemctl", "show", f"--property={','.join(names)}", unit_name],
+        QUERY_TIMEOUT,
+        retries=RETRIES,
+        stdout=asyncio.subprocess.PIPE,
+    )
+    return parse_properties(stdout.decode("utf8", "replace"))
+
+
+def parse_properties(output):
+    """
+    Parse `KEY=VALUE` lines as output by `systemctl show` into a dict.
+    """
+    properties = {}
+    for line in output.splitlines():
+        key, sep, value = line.partition("=")
+        if sep:
+            properties[key] = value
+    return properties
+
+
+async def follow_journal(unit_name, since=None, idle_timeout=None, namespace=None):
+    """
+    Follow the journal of service with given name, yielding log messages as
+    they are written.
+
+    Messages are only read from journalctl as fast as they are consumed, so a
+    chatty unit is held back by the pipe instead of being buffered in memory.
+    If idle_timeout is set, None is yielded whenever no message has been
+    written for that many seconds, allowing the caller to do other work.
+
+    If the unit logs to a journal namespace (LogNamespace=), it must be passed
+    as namespace to find its messages.
+
+    The journalctl process is terminated as soon as the generator is closed.
+
+    ref: https://www.freedesktop.org/software/systemd/man/journalctl.html
+    """
+    cmd = [
+        "journalctl",
+        "--unit",
+        unit_name,
+        "--follow",
+        "--output=cat",
+        "--no-pager",
+        "--quiet",
+    ]
+    if namespace:
+        cmd.append(f"--namespace={namespace}")
+    if since is None:
+        cmd.append("--lines=0")
+    else:
+        cmd.append(f"--since=@{int(since)}")
+
+    proc = await asyncio.create_subprocess_exec(
+        *cmd,
+        stdout=asyncio.subprocess.PIPE,
+        stderr=asyncio.subprocess.DEVNULL,
+        limit=JOURNAL_LINE_LIMIT,
+    )
+    try:
+        while True:
+            try:
+                line = await asyncio.wait_for(proc.stdout.readline(), idle_timeout)
+            except asyncio.TimeoutError:
+                yield None
+                continue
+            except ValueError:
+                # line longer than JOURNAL_LINE_LIMIT, already discarded
+                continue
+            if not line:
+                break
+            yield line.decode("utf8", "replace").rstrip("\n")
+    finally:
+        if proc.returncode is None:
+            proc.terminate()
+        await proc.wait()
+
+
+async def count_journal_entries(namespace, after_cursor=None, since=None):
+    """
+    Count the entries written to a journal namespace after the entry with
+    given cursor, or else since a UTC timestamp, and the bytes of their
+    messages.
+
+    Returns (entries, message_bytes, cursor), where cursor is that of the last
+    entry counted, or None if there were none.
+
+    ref: https://www.freedesktop.org/software/systemd/man/journalctl.html#--after-cursor=
+    ref: https://www.freedesktop.org/software/systemd/man/systemd-journald.service.html#Journal%20Namespaces
+    """
+    cmd = [
+        "journalctl",
+        f"--namespace={namespace}",
+        "--output=json",
+        # __CURSOR is always included
+        "--output-fields=MESSAGE",
+        "--no-pager",
+        "--quiet",
+    ]
+    if after_cursor:
+        cmd.append(f"--after-cursor={after_cursor}")
+    elif since is not None:
+        cmd.append(f"--since=@{int(since)}")
+
+    proc = await asyncio.create_subprocess_exec(
+        *cmd,
+        stdout=asyncio.subprocess.PIPE,
+        stderr=asyncio.subprocess.DEVNULL,
+        limit=JOURNAL_LINE_LIMIT,
+    )
+    entries = message_bytes = 0
+    cursor = None
+    try:
+        while True:
+            try:
+                line = await proc.stdout.readline()
+            except ValueError:
+                # entry longer than JOURNAL_LINE_LIMIT, already discarded
+                entries += 1
+                message_bytes += JOURNAL_LINE_LIMIT
+                continue
+            if not line:
+                break
+            entry = json.loads(line)
+            entries += 1
+            message = entry.get("MESSAGE")
+            if isinstance(message, list):
+                # messages that aren't valid UTF-8 are arrays of bytes
+                message_bytes += len(message)
+            elif message:
+                message_bytes += len(message.encode("utf8"))
+            cursor = entry["__CURSOR"]
+    finally:
+        if proc.returncode is None:
+            proc.terminate()
+        await proc.wait()
+    return entries, message_bytes, cursor
+
+
 async def stop_service(unit_name):
     """
     Stop service with given name.
 
     Throws CalledProcessError if stopping fails
     """
-    proc = await asyncio.create_subprocess_exec("systemctl", "stop", unit_name)
-    await proc.wait()
+    await run_systemd_command(
+        "stop",
+        ["systemctl", "stop", unit_name],
+        STOP_TIMEOUT,
+        retries=RETRIES,
+        stdout=None,
+    )
 
 
 async def reset_service(unit_name):
@@ -219,14 +629,22 @@ async def reset_service(unit_name):
 
     Throws CalledProcessError if resetting fails
     """
-    proc = await asyncio.create_subprocess_exec("systemctl", "reset-failed", unit_name)
-    await proc.wait()
+    await run_systemd_command(
+        "reset-failed",
+        ["systemctl", "reset-failed", unit_name],
+        QUERY_TIMEOUT,
+        retries=RETRIES,
+        stdout=None,
+    )
 
 
 @functools.lru_cache
 def get_systemd_version():
     """
     Returns systemd's major version, or None if failing to do so.
+
+    This blocks while running `systemctl --version`, see
+    capabilities.probe_systemd_version for an async alternative.
     """
     try:
         version_response = subprocess.check_output(["systemctl", "--version"])
@@ -236,7 +654,16 @@ def get_systemd_version():
             RuntimeWarning,
             stacklevel=2,
         )
+        return None
+
+    return parse_systemd_version(version_response)
 
+
+def parse_systemd_version(version_response):
+    """
+    Returns systemd's major version from the output of `systemctl --version`,
+    or None if failing to do so.
+    """
     try:
         # Example response from Ubuntu 22.04:
         #
@@ -1,18 +1,96 @@
 import asyncio
+import functools
+import inspect
 import os
 import pwd
-import sys
+import re
+import time
 import warnings
+from datetime import datetime, timezone
 
 from jupyterhub.spawner import Spawner
-from jupyterhub.utils import random_port
-from traitlets import Bool, Dict, List, Unicode
-
-from systemdspawner import systemd
+from jupyterhub.traitlets import ByteSpecification
+from jupyterhub.utils import wait_for_http_server
+from traitlets import (
+    Any,
+    Bool,
+    Dict,
+    Enum,
+    Float,
+    Integer,
+    List,
+    TraitError,
+    Unicode,
+    validate,
+)
+
+from systemdspawner import broker, capabilities, cgroups, ports, systemd, zygote
+from systemdspawner.metrics import (
+    HOME_SEEDING_DURATION_SECONDS,
+    LOG_NAMESPACE_MESSAGE_BYTES,
+    LOG_NAMESPACE_MESSAGES,
+    MEMORY_EVENTS,
+    PRESSURE,
+    SERVER_READY_DURATION_SECONDS,
+    SPAWNS_DELAYED_BY_PRESSURE,
+)
 
 SYSTEMD_REQUIRED_VERSION = 243
 SYSTEMD_LOWEST_RECOMMENDED_VERSION = 245
 
+# seconds between checks of whether seeding a home directory has completed
+HOME_SEEDING_POLL_INTERVAL = 0.5
+
+# Spawn progress reported by progress() for the ActiveState of the unit
+UNIT_STATE_PROGRESS = {
+    "activating": (20, "Starting systemd unit"),
+    "active": (30, "Systemd unit started, starting Jupyter server"),
+}
+
+# Spawn progress reported by progress() for recognised log lines from the user
+# server, once reaching SERVER_READY_PROGRESS the journal is no longer followed
+SERVER_LOG_PROGRESS = [
+    (
+        re.compile(r"[Ss]tarting jupyterhub[ -]single-?user"),
+        50,
+        "Starting Jupyter server",
+    ),
+    (
+        re.compile(r"[Ee]xtension .*(loaded|linked)|[Ll]oading .*extension"),
+        70,
+        "Loading Jupyter server extensions",
+    ),
+    (
+        re.compile(r"is running at|Serving notebooks from"),
+        90,
+        "Jupyter server is running, waiting for it to respond",
+    ),
+]
+SERVER_READY_PROGRESS = 90
+
+# systemd version that introduced ManagedOOMMemoryPressure= for systemd-oomd
+MANAGED_OOM_SYSTEMD_VERSION = 247
+
+# systemd version that introduced LogNamespace= and per unit log rate limits
+LOG_NAMESPACE_SYSTEMD_VERSION = 245
+
+# systemd versions that introduced MountImages= and ExtensionImages=, used by
+# environment profiles
+MOUNT_IMAGES_SYSTEMD_VERSION = 247
+EXTENSION_IMAGES_SYSTEMD_VERSION = 248
+
+# Seconds between measurements of the size of a log namespace's journal
+LOG_NAMESPACE_MEASURE_INTERVAL = 30
+
+# Resources with pressure stall information
+PRESSURE_RESOURCES = ["cpu", "memory", "io"]
+
+# Seconds between checks of pressure while a spawn is delayed by it
+PRESSURE_CHECK_INTERVAL = 5
+
+# Name of the systemd service running the zygote of an environment profile
+ZYGOTE_UNIT_NAME_TEMPLATE = "jupyterhub-zygote-{profile}"
+
 
 class SystemdSpawner(Spawner):
     user_workingdir = Unicode(
@@ -137,6 +215,24 @@ class SystemdSpawner(Spawner):
         """,
     ).tag(config=True)
 
+    home_template = Unicode(
+        None,
+        allow_none=True,
+        help="""
+        Directory to populate the home directory of dynamic users from, on
+        their first spawn, with skeleton notebooks, configuration, etc.
+
+        Only used with dynamic_users. The template is copied with reflinks
+        before the user server starts if the filesystem supports them, which
+        only copies metadata. Otherwise the template is copied in the
+        background while the user server starts, without overwriting files
+        the user has already created. The copy runs as the dynamic user in its
+        own systemd service, so the template must be readable by all users.
+
+        {USERNAME} and {USERID} are expanded.
+        """,
+    ).tag(config=True)
+
     slice = Unicode(
         None,
         allow_none=True,
@@ -147,29 +243,547 @@ class SystemdSpawner(Spawner):
         """,
     ).tag(config=True)
 
+    port_range = List(
+        [],
+        help="""
+        Range of ports [first, last] to allocate ports for user servers from,
+        for example to match firewall rules.
+
+        Ports are reserved by the hub until a user server stops, so concurrent
+        spawns never get the same port. Defaults to [], which picks a random
+        free port each time.
+        """,
+    ).tag(config=True)
+
+    @validate("port_range")
+    def _validate_port_range(self, proposal):
+        port_range = proposal.value
+        if port_range and (
+            len(port_range) != 2 or not 0 < port_range[0] <= port_range[1] < 65536
+        ):
+            raise TraitError(f"port_range must be [first, last], got {port_range}")
+        return port_range
+
+    environment_profiles = Dict(
+        {},
+        help="""
+        Dict of named environment profiles, shared read-only software
+        environments (such as a conda or venv stack) mounted into user units.
+
+        Each profile is a dict with the following optional keys:
+
+        - path: a directory tree to mount read-only into the unit
+        - image: a squashfs or erofs image to mount read-only into the unit,
+          requires mount_point to be set and systemd 247
+        - mount_point: where to mount path or image, defaults to path
+        - extension_images: list of system extension images to overlay on
+          /usr and /opt of the unit, requires systemd 248
+        - extra_paths: list of paths to prepend to $PATH, like extra_paths
+
+        As the same files are mounted for all users of a profile, the kernel's
+        page cache for them is shared as well, making imports in user servers
+        faster after the first one.
+
+        The profile is selected by user_options["environment_profile"] or
+        default_environment_profile, and is recorded in the spawner state.
+
+        {USERNAME} and {USERID} are expanded in path, image, mount_point and
+        extra_paths.
+        """,
+    ).tag(config=True)
+
+    default_environment_profile = Unicode(
+        None,
+        allow_none=True,
+        help="""
+        Name of the environment profile in environment_profiles to use if a
+        user hasn't selected one.
+
+        Defaults to None, which uses no environment profile.
+        """,
+    ).tag(config=True)
+
+    use_zygote = Bool(
+        False,
+        help="""
+        Start user servers by forking them from a zygote process, which has
+        already imported the modules of the user server.
+
+        A zygote is started as its own systemd service for each environment
+        profile, and runs as root to be able to fork a child for each user
+        server that drops privileges to the user. The child is moved into a
+        transient systemd scope unit named like unit_name_template, and its
+        resource control properties (mem_limit, cpu_limit, etc) are set on the
+        scope before it starts running the user server.
+
+        Scopes don't support properties configuring the execution environment
+        of processes, apart from NoNewPrivileges which the child sets on itself.
+        If the user's unit needs such properties, for example with dynamic_users,
+        isolate_tmp or readonly_paths, the user server is started as a regular
+        systemd service instead. Environment profiles are mounted into the
+        zygote's service, and are inherited by the children.
+        """,
+    ).tag(config=True)
+
+    zygote_python = Unicode(
+        "python3",
+        help="""
+        Python executable running the zygote, it should be the Python of the
+        user servers. If not absolute, it is looked up on $PATH with the
+        extra_paths of the environment profile prepended.
+        """,
+    ).tag(config=True)
+
+    zygote_preload_modules = List(
+        zygote.DEFAULT_PRELOAD_MODULES,
+        help="""
+        Modules imported by the zygote before forking user servers.
+
+        If jupyterhub.singleuser is preloaded, user servers whose environment
+        sets JUPYTERHUB_SINGLEUSER_APP or JUPYTERHUB_SINGLEUSER_EXTENSION
+        differently than the zygote's are executed rather than forked, as the
+        server application is chosen when it is imported.
+        """,
+    ).tag(config=True)
+
+    # one lock for each zygote, to start it only once
+    _zygote_locks = {}
+
+    # time.monotonic() when pressure was last read by any spawner
+    _pressure_read_at = 0
+
+    broker_socket = Unicode(
+        None,
+        allow_none=True,
+        help="""
+        Unix socket of a broker calling systemd on behalf of the hub, started
+        with `python3 -m systemdspawner.broker --socket <path> --allowed-user
+        <hub user>`.
+
+        When set, the hub doesn't fork systemctl and systemd-run itself, and
+        doesn't need to run as root. Requests are pipelined over one
+        connection, and the broker batches concurrent queries of whether user
+        servers are running into a single systemctl call.
+
+        The broker only manages units named with its `--unit-prefix`es, and
+        only starts units with NoNewPrivileges=yes as unprivileged users, so
+        use_zygote isn't supported. unit_extra_properties must be allowed with
+        its `--allowed-property`.
+
+        Defaults to None, which calls systemd from the hub process.
+        """,
+    ).tag(config=True)
+
+    capabilities_cache_path = Unicode(
+        "/var/cache/jupyterhub-systemdspawner/capabilities.json",
+        allow_none=True,
+        help="""
+        Path to persist probed systemd and kernel capabilities to, so they are
+        only probed again after a reboot.
+
+        Capabilities are probed in the background when the hub starts, and
+        features not supported by the machine are disabled with a warning,
+        such as cpu_limit without kernel support for CPU bandwidth control.
+
+        Set to None to probe on each hub start instead.
+        """,
+    ).tag(config=True)
+
+    # set when probed capabilities have been logged, to only log them once
+    _capabilities_logged = False
+
+    monitor_memory_events = Bool(
+        True,
+        help="""
+        Watch the memory.events file of each user unit's cgroup for memory
+        events, such as processes being killed when running out of memory.
+
+        Events are logged, counted per user in the spawner state and in the
+        systemdspawner_memory_events metric, and passed to memory_event_hook.
+        The file is watched with inotify, so monitoring doesn't poll.
+
+        Requires cgroup v2.
+        """,
+    ).tag(config=True)
+
+    memory_event_hook = Any(
+        None,
+        help="""
+        An optional hook function called with the spawner and a dict of the
+        increase of each memory.events counter whenever memory events occur in
+        the user's unit, for example to notify the user's server that a kernel
+        has been killed for running out of memory.
+
+        The hook may be a coroutine. Example::
+
+            def my_hook(spawner, events):
+                if "oom_kill" in events:
+                    notify(spawner.user.name, "A process was killed, out of memory")
+
+            c.SystemdSpawner.memory_event_hook = my_hook
+        """,
+    ).tag(config=True)
+
+    memory_policy = Enum(
+        ["max", "tiered"],
+        default_value="max",
+        help="""
+        How mem_limit and mem_guarantee are enforced.
+
+        - max: mem_limit is a hard limit (MemoryMax), and mem_guarantee is
+          ignored.
+        - tiered: mem_limit is a throttle point (MemoryHigh), above which the
+          unit's memory is reclaimed heavily instead of processes being killed,
+          and a hard limit (MemoryMax) is set at mem_limit times
+          memory_max_factor. mem_guarantee is protected from reclaim by other
+          units' memory pressure (MemoryLow, or MemoryMin if
+          memory_guarantee_hard is set).
+
+        The tiered policy allows overcommitting memory on a machine, with
+        graceful reclaim instead of out of memory kills. Requires cgroup v2.
+        """,
+    ).tag(config=True)
+
+    memory_max_factor = Float(
+        1.25,
+        help="""
+        With memory_policy set to tiered, the hard memory limit (MemoryMax) is
+        set to mem_limit times this factor.
+        """,
+    ).tag(config=True)
+
+    memory_guarantee_hard = Bool(
+        False,
+        help="""
+        With memory_policy set to tiered, protect mem_guarantee from reclaim
+        unconditionally (MemoryMin) rather than on a best effort basis
+        (MemoryLow).
+        """,
+    ).tag(config=True)
+
+    memory_swap_max = ByteSpecification(
+        None,
+        help="""
+        Maximum amount of swap each user can use (MemorySwapMax). You can use
+        the suffixes K, M, G or T like for mem_limit.
+
+        Defaults to None, which doesn't limit swap use.
+        """,
+    ).tag(config=True)
+
+    oomd_memory_pressure_limit = Unicode(
+        None,
+        allow_none=True,
+        help="""
+        Let systemd-oomd kill a user's unit when its memory pressure stays above
+        this limit, a percentage such as "60%", rather than waiting for the
+        kernel to kill processes when running out of memory.
+
+        This sets ManagedOOMMemoryPressure=kill and
+        ManagedOOMMemoryPressureLimit on each user unit. To act on the
+        pressure of all users together instead, set these on the slice.
+
+        Requires systemd 247 and systemd-oomd to be running.
+        """,
+    ).tag(config=True)
+
+    io_read_bandwidth_max = ByteSpecification(
+        None,
+        allow_none=True,
+        help="""
+        Maximum bytes per second a user's unit can read from the device backing
+        its working directory, such as "100M".
+
+        The device is resolved by systemd from the working directory, or its
+        nearest existing parent directory. Requires cgroup v2 with the io
+        controller, as do the other io_* options.
+
+        ref: https://www.freedesktop.org/software/systemd/man/systemd.resource-control.html#IOReadBandwidthMax=device%20bytes
+        """,
+    ).tag(config=True)
+
+    io_write_bandwidth_max = ByteSpecification(
+        None,
+        allow_none=True,
+        help="""
+        Maximum bytes per second a user's unit can write to the device backing
+        its working directory, such as "50M".
+        """,
+    ).tag(config=True)
+
+    io_read_iops_max = Integer(
+        None,
+        allow_none=True,
+        help="""
+        Maximum read operations per second a user's unit can do on the device
+        backing its working directory.
+        """,
+    ).tag(config=True)
+
+    io_write_iops_max = Integer(
+        None,
+        allow_none=True,
+        help="""
+        Maximum write operations per second a user's unit can do on the device
+        backing its working directory.
+        """,
+    ).tag(config=True)
+
+    io_device_latency_target = Unicode(
+        None,
+        allow_none=True,
+        help="""
+        Target average IO latency of the device backing a user's working
+        directory, a systemd time span such as "25ms".
+
+        When the latency of the device exceeds the target for some unit, other
+        units using the device are throttled, protecting users with modest IO
+        from one saturating the device. Set the same target for all user units.
+
+        ref: https://www.freedesktop.org/software/systemd/man/systemd.resource-control.html#IODeviceLatencyTargetSec=device%20target
+        """,
+    ).tag(config=True)
+
+    scratch_size = ByteSpecification(
+        None,
+        allow_none=True,
+        help="""
+        Size of a private tmpfs mounted at scratch_path in user units, for fast
+        temporary files, such as "2G".
+
+        Files in it are kept in memory, and charged to the memory of the user's
+        unit, so they count towards mem_limit. They are removed when the user's
+        server stops.
+        """,
+    ).tag(config=True)
+
+    scratch_path = Unicode(
+        "/tmp",
+        help="""
+        Path to mount the tmpfs of scratch_size at. Defaults to /tmp, replacing
+        isolate_tmp's private /tmp on disk with one in memory.
+        """,
+    ).tag(config=True)
+
+    spawn_pressure_thresholds = Dict(
+        {},
+        help="""
+        Dict of resource ("cpu", "memory" or "io") to a pressure percentage
+        above which new user servers aren't started.
+
+        Pressure is the share of time in the last 10 seconds some processes
+        were stalled waiting for the resource (the "some avg10" value of pressure
+        stall information). It is checked for the whole node, and for the slice
+        if set. While above a threshold, starting a user server waits with a
+        progress message for up to spawn_pressure_timeout seconds, and then
+        fails.
+
+        Pressure is exposed as the systemdspawner_pressure metric, read when
+        spawning and when polling running servers, at most every 5 seconds.
+        Requires a kernel with pressure stall information, and cgroup v2 for
+        the slice's pressure.
+        """,
+    ).tag(config=True)
+
+    spawn_pressure_timeout = Integer(
+        30,
+        help="""
+        Seconds to wait for pressure to drop below spawn_pressure_thresholds
+        before failing to start a user server. This should be less than
+        start_timeout.
+        """,
+    ).tag(config=True)
+
+    cpu_policy = Enum(
+        ["quota", "weight"],
+        default_value="quota",
+        help="""
+        How cpu_limit and cpu_guarantee are enforced.
+
+        - quota: cpu_limit is a hard limit (CPUQuota), and cpu_guarantee is
+          ignored.
+        - weight: in addition, each unit gets a share of the CPU proportional
+          to its cpu_guarantee when CPU is contended (CPUWeight of
+          cpu_guarantee times cpu_weight_per_cpu), and can otherwise use idle
+          CPU up to cpu_limit if set. See also spawn_cpu_weight and
+          cpu_batch_weight.
+        """,
+    ).tag(config=True)
+
+    cpu_weight_per_cpu = Integer(
+        100,
+        help="""
+        With cpu_policy set to weight, the CPUWeight per CPU of cpu_guarantee.
+        Units get the default CPUWeight of 100 without cpu_guarantee.
+        """,
+    ).tag(config=True)
+
+    spawn_cpu_weight = Integer(
+        None,
+        allow_none=True,
+        help="""
+        With cpu_policy set to weight, the CPUWeight of a unit while its user
+        server is starting, to make starting servers faster on a busy machine.
+        It is kept until the server responds to HTTP requests.
+        """,
+    ).tag(config=True)
+
+    cpu_batch_weight = Integer(
+        None,
+        allow_none=True,
+        help="""
+        With cpu_policy set to weight, the CPUWeight of units whose user server
+        has had no activity for cpu_batch_after seconds, such as a server left
+        running a long computation. Units get their regular weight back when
+        activity is seen again. Checked on each poll.
+        """,
+    ).tag(config=True)
+
+    cpu_batch_after = Integer(
+        600,
+        help="""
+        Seconds without activity after which a unit gets cpu_batch_weight.
+        """,
+    ).tag(config=True)
+
+    log_namespace = Unicode(
+        None,
+        allow_none=True,
+        help="""
+        Journal namespace for user units to log to (LogNamespace=), served by
+        its own systemd-journald@NAMESPACE instance. This keeps noisy user
+        servers from slowing down the system journal, and the hub's logging.
+
+        {USERNAME} and {USERID} are expanded, but a namespace is typically
+        shared by a group of users, such as all users in a slice.
+
+        The messages logged to each namespace, and their bytes, are exposed as
+        the systemdspawner_log_namespace_messages and
+        systemdspawner_log_namespace_message_bytes metrics. Requires systemd
+        245.
+        """,
+    ).tag(config=True)
+
+    log_rate_limit_interval = Unicode(
+        None,
+        allow_none=True,
+        help="""
+        Time span such as "30s", in which each user unit may log at most
+        log_rate_limit_burst messages before further messages are dropped
+        (LogRateLimitIntervalSec=). Requires systemd 245.
+        """,
+    ).tag(config=True)
+
+    log_rate_limit_burst = Integer(
+        None,
+        allow_none=True,
+        help="""
+        Number of messages each user unit may log per log_rate_limit_interval
+        (LogRateLimitBurst=). Requires systemd 245.
+        """,
+    ).tag(config=True)
+
+    log_level_max = Unicode(
+        None,
+        allow_none=True,
+        help="""
+        Most verbose log level of messages from user units that are kept, such
+        as "info" to drop debug messages (LogLevelMax=).
+        """,
+    ).tag(config=True)
+
+    # namespace -> (time.monotonic() when last counted, cursor of the last entry
+    # counted, time.time() to count from if no entry has been counted)
+    _log_namespace_positions = {}
+    # tasks counting messages logged to namespaces
+    _log_namespace_tasks = set()
+
     def __init__(self, *args, **kwargs):
         super().__init__(*args, **kwargs)
         # All traitlets configurables are configured by now
         self.unit_name = self._expand_user_vars(self.unit_name_template)
+        # set by start(), used to follow the unit's journal from then on
+        self._start_time = None
+        # task measuring the time until the started server responds
+        self._ready_task = None
+        # set by start(), or by load_state to the profile of a running server
+        self.environment_profile = None
+        # set by start(), or by load_state, if the server runs in a scope
+        # forked from a zygote instead of a service
+        self.zygote_scope = False
+        # CPUWeight last set on the running unit, with cpu_policy "weight"
+        self._cpu_weight = None
+        # journal namespace the running unit logs to
+        self._log_namespace = None
+        # message about a spawn being delayed by pressure, for progress()
+        self._pressure_message = None
+        # memory.events counters summed over all of the user's units
+        self.memory_events = {}
+        # set once the home directory has been seeded from home_template
+        self.home_seeded = False
+        # task waiting for the home directory to be seeded in the background
+        self._home_seeding_task = None
+        # inotify watch descriptor of, and last read, memory.events
+        self._memory_events_wd = None
+        self._memory_events_last = {}
+        # tasks running an async memory_event_hook
+        self._memory_event_hook_tasks = set()
 
         self.log.debug(
             "user:%s Initialized spawner with unit %s", self.user.name, self.unit_name
         )
 
-        systemd_version = systemd.get_systemd_version()
+        # probe capabilities in the background as early as possible, spawners
+        # are created as the hub starts, and they are awaited in start()
+        try:
+            capabilities.start_probe(self.capabilities_cache_path)
+        except RuntimeError:
+            # no running event loop
+            pass
+
+    async def _get_capabilities(self):
+        """
+        Return probed systemd and kernel capabilities, after checking that
+        systemd is recent enough.
+        """
+        caps = await capabilities.get_capabilities(self.capabilities_cache_path)
+        systemd_version = caps["systemd_version"]
         if systemd_version is None:
             # not found, nothing to check
-            # already warned about this in get_systemd_version
+            # already warned about this when probing
             pass
         elif systemd_version < SYSTEMD_REQUIRED_VERSION:
-            self.log.critical(
+            raise RuntimeError(
                 f"systemd version {SYSTEMD_REQUIRED_VERSION} or higher is required, version {systemd_version} is used"
             )
-            sys.exit(1)
-        elif systemd_version < SYSTEMD_LOWEST_RECOMMENDED_VERSION:
-            warnings.warn(
-                f"systemd version {SYSTEMD_LOWEST_RECOMMENDED_VERSION} or higher is recommended, version {systemd_version} is used"
-            )
+
+        if not SystemdSpawner._capabilities_logged:
+            SystemdSpawner._capabilities_logged = True
+            self.log.info("Probed systemd capabilities: %s", caps)
+            if (
+                systemd_version is not None
+                and systemd_version < SYSTEMD_LOWEST_RECOMMENDED_VERSION
+            ):
+                warnings.warn(
+                    f"systemd version {SYSTEMD_LOWEST_RECOMMENDED_VERSION} or higher is recommended, version {systemd_version} is used"
+                )
+            if caps["cpu_quota"] is False:
+                self.log.warning(
+                    "The kernel doesn't support CPU bandwidth control, cpu_limit is ignored"
+                )
+            if not caps["memory_limit"]:
+                self.log.warning(
+                    "The kernel's memory cgroup controller isn't enabled, mem_limit is ignored"
+                )
+            if self._io_limits() and not self._io_controller(caps):
+                self.log.warning(
+                    "The io cgroup controller isn't enabled, io_* options are ignored"
+                )
+            if self.spawn_pressure_thresholds and not caps["pressure"]:
+                self.log.warning(
+                    "The kernel doesn't provide pressure stall information, spawn_pressure_thresholds is ignored"
+                )
+        return caps
 
     def _expand_user_vars(self, string):
         """
@@ -194,6 +808,18 @@ class SystemdSpawner(Spawner):
         """
         state = super().get_state()
         state["unit_name"] = self.unit_name
+        if self.environment_profile:
+            state["environment_profile"] = self.environment_profile
+        if self.zygote_scope:
+            state["zygote_scope"] = True
+        if self.memory_events:
+            state["memory_events"] = self.memory_events
+        if self._log_namespace:
+            state["log_namespace"] = self._log_namespace
+        if self.port:
+            state["port"] = self.port
+        if self.home_seeded:
+            state["home_seeded"] = True
         return state
 
     def load_state(self, state):
@@ -209,9 +835,295 @@ class SystemdSpawner(Spawner):
         """
         if "unit_name" in state:
             self.unit_name = state["unit_name"]
+        if "environment_profile" in state:
+            self.environment_profile = state["environment_profile"]
+        self.zygote_scope = state.get("zygote_scope", False)
+        self.memory_events = state.get("memory_events", {})
+        self._log_namespace = state.get("log_namespace")
+        self.home_seeded = state.get("home_seeded", False)
+        if "port" in state:
+            # keep the running user server's port reserved after a hub restart
+            self.port = state["port"]
+            ports.allocator.reserve(self.port)
+
+    def clear_state(self):
+        """
+        Clear state of a stopped user server, releasing its port.
+        """
+        super().clear_state()
+        self._start_time = None
+        self._release_port()
+
+    def _release_port(self):
+        """
+        Release the port reserved for the user server, if any. The port is
+        reset, so that it isn't released again once reserved by another spawn.
+        """
+        if self.port:
+            ports.allocator.release(self.port)
+            self.port = 0
+
+    @property
+    def _systemd(self):
+        """
+        The systemd module, or a client of the broker providing the same
+        functions if broker_socket is set.
+        """
+        if self.broker_socket:
+            return broker.get_client(self.broker_socket)
+        return systemd
+
+    @property
+    def _systemd_unit_name(self):
+        """
+        Full name of the systemd unit running the user server.
+        """
+        if self.zygote_scope:
+            return f"{self.unit_name}.scope"
+        return self.unit_name
+
+    def _memory_properties(self, caps):
+        """
+        Return systemd unit properties enforcing mem_limit, mem_guarantee and
+        the other memory options according to memory_policy.
+
+        ref: https://www.freedesktop.org/software/systemd/man/systemd.resource-control.html#MemoryMin=bytes
+        """
+        properties = {}
+        if self.mem_limit is not None:
+            properties["MemoryAccounting"] = "yes"
+            if self.memory_policy == "tiered":
+                properties["MemoryHigh"] = self.mem_limit
+                properties["MemoryMax"] = int(self.mem_limit * self.memory_max_factor)
+            else:
+                properties["MemoryMax"] = self.mem_limit
+
+        if self.mem_guarantee is not None and self.memory_policy == "tiered":
+            properties["MemoryAccounting"] = "yes"
+            if self.memory_guarantee_hard:
+                properties["MemoryMin"] = self.mem_guarantee
+            else:
+                properties["MemoryLow"] = self.mem_guarantee
+
+        if self.memory_swap_max is not None:
+            properties["MemorySwapMax"] = self.memory_swap_max
+
+        if self.oomd_memory_pressure_limit is not None:
+            systemd_version = caps["systemd_version"]
+            if (
+                systemd_version is not None
+                and systemd_version < MANAGED_OOM_SYSTEMD_VERSION
+            ):
+                self.log.warning(
+                    "oomd_memory_pressure_limit requires systemd version %s or higher, version %s is used",
+                    MANAGED_OOM_SYSTEMD_VERSION,
+                    systemd_version,
+                )
+            else:
+                # ref: https://www.freedesktop.org/software/systemd/man/systemd.resource-control.html#ManagedOOMSwap=auto%7Ckill
+                properties["ManagedOOMMemoryPressure"] = "kill"
+                properties[
+                    "ManagedOOMMemoryPressureLimit"
+                ] = self.oomd_memory_pressure_limit
+
+        return properties
+
+    def _io_limits(self):
+        """
+        Return the configured IO limits, as systemd property name to value.
+        """
+        limits = {
+            "IOReadBandwidthMax": self.io_read_bandwidth_max,
+            "IOWriteBandwidthMax": self.io_write_bandwidth_max,
+            "IOReadIOPSMax": self.io_read_iops_max,
+            "IOWriteIOPSMax": self.io_write_iops_max,
+            "IODeviceLatencyTargetSec": self.io_device_latency_target,
+        }
+        return {name: value for name, value in limits.items() if value is not None}
+
+    @staticmethod
+    def _io_controller(caps):
+        return caps["cgroup_version"] == 2 and "io" in caps["cgroup_controllers"]
+
+    def _io_properties(self, caps, working_dir):
+        """
+        Return systemd unit properties limiting IO on the device backing
+        working_dir.
+
+        Systemd resolves the block device backing a path, which must exist. As
+        the working directory may only be created as the unit starts, such as
+        with dynamic_users, its nearest existing parent is used.
+        """
+        limits = self._io_limits()
+        if not limits or not self._io_controller(caps):
+            return {}
+        path = os.path.abspath(working_dir)
+        while not os.path.exists(path):
+            path = os.path.dirname(path)
+        properties = {"IOAccounting": "yes"}
+        for name, value in limits.items():
+            properties[name] = f"{path} {value}"
+        return properties
+
+    def _get_log_namespace(self, caps):
+        """
+        Return the journal namespace the user's unit logs to, or None.
+        """
+        systemd_version = caps["systemd_version"]
+        if self.log_namespace is None or (
+            systemd_version is not None
+            and systemd_version < LOG_NAMESPACE_SYSTEMD_VERSION
+        ):
+            return None
+        return self._expand_user_vars(self.log_namespace)
+
+    def _log_properties(self, caps):
+        """
+        Return systemd unit properties for logging of the user's unit.
+
+        ref: https://www.freedesktop.org/software/systemd/man/systemd.exec.html#LogNamespace=
+        """
+        properties = {}
+        if self.log_level_max is not None:
+            properties["LogLevelMax"] = self.log_level_max
+
+        options = [
+            self.log_namespace,
+            self.log_rate_limit_interval,
+            self.log_rate_limit_burst,
+        ]
+        if all(option is None for option in options):
+            return properties
+        systemd_version = caps["systemd_version"]
+        if (
+            systemd_version is not None
+            and systemd_version < LOG_NAMESPACE_SYSTEMD_VERSION
+        ):
+            self.log.warning(
+                "log_namespace and log_rate_limit_* require systemd version %s or higher, version %s is used",
+                LOG_NAMESPACE_SYSTEMD_VERSION,
+                systemd_version,
+            )
+            return properties
+
+        if self.log_namespace is not None:
+            properties["LogNamespace"] = self._get_log_namespace(caps)
+        if self.log_rate_limit_interval is not None:
+            properties["LogRateLimitIntervalSec"] = self.log_rate_limit_interval
+        if self.log_rate_limit_burst is not None:
+            properties["LogRateLimitBurst"] = self.log_rate_limit_burst
+        return properties
+
+    def _measure_log_namespace(self):
+        """
+        Count the messages logged to the unit's log namespace since last
+        counted, in the background and at most every
+        LOG_NAMESPACE_MEASURE_INTERVAL seconds for each namespace.
+        """
+        namespace = self._log_namespace
+        if not namespace:
+            return
+        now = time.monotonic()
+        counted_at, cursor, since = self._log_namespace_positions.get(
+            namespace, (0, None, None)
+        )
+        if now - counted_at < LOG_NAMESPACE_MEASURE_INTERVAL:
+            return
+        if cursor is None and since is None:
+            # messages logged before the hub started aren't counted
+            self._log_namespace_positions[namespace] = (now, None, time.time())
+            return
+        # claimed before counting, so that other spawners don't count the same
+        # messages concurrently
+        self._log_namespace_positions[namespace] = (now, cursor, since)
+        task = asyncio.ensure_future(
+            self._count_log_namespace(namespace, cursor, since)
+        )
+        self._log_namespace_tasks.add(task)
+        task.add_done_callback(self._log_namespace_tasks.discard)
+
+    async def _count_log_namespace(self, namespace, cursor, since):
+        try:
+            entries, message_bytes, last_cursor = await systemd.count_journal_entries(
+                namespace, after_cursor=cursor, since=since
+            )
+        except (OSError, ValueError) as e:
+            self.log.debug(
+                "Failed to count messages of log namespace %s: %s", namespace, e
+            )
+            return
+        if last_cursor:
+            counted_at = self._log_namespace_positions[namespace][0]
+            self._log_namespace_positions[namespace] = (counted_at, last_cursor, None)
+        if entries:
+            LOG_NAMESPACE_MESSAGES.labels(namespace=namespace).inc(entries)
+            LOG_NAMESPACE_MESSAGE_BYTES.labels(namespace=namespace).inc(message_bytes)
+
+    def _environment_profile_properties(self, profile, caps):
+        """
+        Return systemd unit properties mounting an environment profile's
+        directory tree or images read-only into the unit.
+
+        Raises RuntimeError if the profile's images aren't supported by the
+        probed systemd version.
+        """
+        properties = {}
+        systemd_version = caps["systemd_version"]
+        path = profile.get("path")
+        image = profile.get("image")
+        mount_point = profile.get("mount_point") or path
+
+        if path:
+            source = self._expand_user_vars(path)
+            target = self._expand_user_vars(mount_point)
+            # ref: https://www.freedesktop.org/software/systemd/man/systemd.exec.html#BindPaths=
+            properties["BindReadOnlyPaths"] = [
+                source if source == target else f"{source}:{target}"
+            ]
+
+        if image:
+            if not mount_point:
+                raise ValueError(
+                    f"Environment profile with image {image} has no mount_point"
+                )
+            self._check_image_systemd_version(
+                "image", MOUNT_IMAGES_SYSTEMD_VERSION, systemd_version
+            )
+            # ref: https://www.freedesktop.org/software/systemd/man/systemd.exec.html#MountImages=
+            properties["MountImages"] = [
+                f"{self._expand_user_vars(image)}:{self._expand_user_vars(mount_point)}:ro"
+            ]
+
+        if profile.get("extension_images"):
+            self._check_image_systemd_version(
+                "extension_images", EXTENSION_IMAGES_SYSTEMD_VERSION, systemd_version
+            )
+            # ref: https://www.freedesktop.org/software/systemd/man/systemd.exec.html#ExtensionImages=
+            properties["ExtensionImages"] = [
+                self._expand_user_vars(i) for i in profile["extension_images"]
+            ]
+
+        return properties
+
+    @staticmethod
+    def _check_image_systemd_version(key, required_version, systemd_version):
+        # an unknown version isn't checked, like elsewhere
+        if systemd_version is not None and systemd_version < required_version:
+            raise RuntimeError(
+                f"Environment profiles with {key} require systemd version {required_version} or higher, version {systemd_version} is used"
+            )
 
     async def start(self):
-        self.port = random_port()
+        self._start_time = time.time()
+        caps = await self._get_capabilities()
+        if self.spawn_pressure_thresholds and caps["pressure"]:
+            await self._wait_for_pressure()
+        # a port allocated for a previous start of the user server
+        self._release_port()
+        self.port = ports.allocator.allocate(self.port_range)
+        if self.user_options.get("prespawned"):
+            # started by systemdspawner.prespawn, ahead of a scheduled peak
+            self.log.info("user:%s Pre-spawning user server", self.user.name)
         self.log.debug(
             "user:%s Using port %s to start spawning user server",
             self.user.name,
@@ -222,14 +1134,14 @@ class SystemdSpawner(Spawner):
         # JupyterHub, a remnant from a previous install or a failed service start
         # from earlier. Regardless, we kill it and start ours in its place.
         # FIXME: Carefully look at this when doing a security sweep.
-        if await systemd.service_running(self.unit_name):
+        if await self._systemd.service_running(self.unit_name):
             self.log.info(
                 "user:%s Unit %s already exists but not known to JupyterHub. Killing",
                 self.user.name,
                 self.unit_name,
             )
-            await systemd.stop_service(self.unit_name)
-            if await systemd.service_running(self.unit_name):
+            await self._systemd.stop_service(self.unit_name)
+            if await self._systemd.service_running(self.unit_name):
                 self.log.error(
                     "user:%s Could not stop already existing unit %s",
                     self.user.name,
@@ -241,24 +1153,46 @@ class SystemdSpawner(Spawner):
 
         # If there's a unit with this name already but sitting in a failed state.
         # Does a reset of the state before trying to start it up again.
-        if await systemd.service_failed(self.unit_name):
+        if await self._systemd.service_failed(self.unit_name):
             self.log.info(
                 "user:%s Unit %s in a failed state. Resetting state.",
                 self.user.name,
                 self.unit_name,
             )
-            await systemd.reset_service(self.unit_name)
+            await self._systemd.reset_service(self.unit_name)
 
         env = self.get_env()
 
         properties = {}
 
+        self.environment_profile = (
+            self.user_options.get("environment_profile")
+            or self.default_environment_profile
+        )
+        profile = {}
+        profile_properties = {}
+        if self.environment_profile:
+            if self.environment_profile not in self.environment_profiles:
+                raise ValueError(
+                    f"Unknown environment profile {self.environment_profile}"
+                )
+            profile = self.environment_profiles[self.environment_profile]
+            profile_properties = self._environment_profile_properties(profile, caps)
+            properties.update(profile_properties)
+
         if self.dynamic_users:
+            # unknown if systemd's version couldn't be probed
+            if caps["dynamic_user"] is False:
+                raise RuntimeError(
+                    f"dynamic_users requires systemd version {capabilities.DYNAMIC_USER_SYSTEMD_VERSION} or higher"
+                )
             properties["DynamicUser"] = "yes"
             properties["StateDirectory"] = self._expand_user_vars("{USERNAME}")
 
             # HOME is not set by default otherwise
             env["HOME"] = self._expand_user_vars("/var/lib/{USERNAME}")
+            if self.home_template and not self.home_seeded:
+                await self._seed_home()
             # Set working directory to $HOME too
             working_dir = env["HOME"]
             # Set uid, gid = None so we don't set them
@@ -280,11 +1214,18 @@ class SystemdSpawner(Spawner):
         if self.isolate_tmp:
             properties["PrivateTmp"] = "yes"
 
+        if self.scratch_size is not None:
+            # ref: https://www.freedesktop.org/software/systemd/man/systemd.exec.html#TemporaryFileSystem=
+            properties[
+                "TemporaryFileSystem"
+            ] = f"{self.scratch_path}:size={self.scratch_size},mode=1777"
+
         if self.isolate_devices:
             properties["PrivateDevices"] = "yes"
 
-        if self.extra_paths:
-            new_path_list = [self._expand_user_vars(p) for p in self.extra_paths]
+        extra_paths = profile.get("extra_paths", []) + self.extra_paths
+        if extra_paths:
+            new_path_list = [self._expand_user_vars(p) for p in extra_paths]
             current_or_default_path = env.get("PATH", os.defpath)
             if current_or_default_path:
                 new_path_list.append(current_or_default_path)
@@ -292,26 +1233,38 @@ class SystemdSpawner(Spawner):
 
         env["SHELL"] = self.default_shell
 
-        if self.mem_limit is not None:
-            properties["MemoryAccounting"] = "yes"
-            properties["MemoryMax"] = self.mem_limit
+        if caps["memory_limit"]:
+            properties.update(self._memory_properties(caps))
+
+        properties.update(self._io_properties(caps, working_dir))
 
-        if self.cpu_limit is not None:
+        if self.cpu_limit is not None and caps["cpu_quota"] is not False:
             # NOTE: The linux kernel must be compiled with the configuration option
             #       CONFIG_CFS_BANDWIDTH, otherwise CPUQuota doesn't have any
             #       effect.
             #
-            #       This can be checked with the check-kernel.bash script in
-            #       this git repository.
+            #       This is probed by the capabilities module, and can be
+            #       checked with the check-kernel.bash script in this git
+            #       repository.
             #
             #       ref: https://github.com/systemd/systemd/blob/v245/README#L35
             #
             properties["CPUAccounting"] = "yes"
             properties["CPUQuota"] = f"{int(self.cpu_limit * 100)}%"
 
+        if self.cpu_policy == "weight":
+            # ref: https://www.freedesktop.org/software/systemd/man/systemd.resource-control.html#CPUWeight=weight
+            self._cpu_weight = self.spawn_cpu_weight or self._get_cpu_weight()
+            properties["CPUAccounting"] = "yes"
+            properties["CPUWeight"] = self._cpu_weight
+
         if self.disable_user_sudo:
             properties["NoNewPrivileges"] = "yes"
 
+        log_properties = self._log_properties(caps)
+        self._log_namespace = log_properties.get("LogNamespace")
+        properties.update(log_properties)
+
         if self.readonly_paths is not None:
             properties["ReadOnlyDirectories"] = [
                 self._expand_user_vars(path) for path in self.readonly_paths
@@ -327,30 +1280,702 @@ class SystemdSpawner(Spawner):
 
         properties.update(self.unit_extra_properties)
 
-        await systemd.start_transient_service(
-            self.unit_name,
-            cmd=[self._expand_user_vars(c) for c in self.cmd],
-            args=[self._expand_user_vars(a) for a in self.get_args()],
-            working_dir=working_dir,
-            environment_variables=env,
-            properties=properties,
-            uid=uid,
-            gid=gid,
-            slice=self.slice,
-        )
+        cmd = [self._expand_user_vars(c) for c in self.cmd]
+        args = [self._expand_user_vars(a) for a in self.get_args()]
+
+        # environment profiles are mounted into the zygote's service instead
+        unit_properties = {
+            k: v for k, v in properties.items() if k not in profile_properties
+        }
+        self.zygote_scope = self.use_zygote and self._zygote_supported(unit_properties)
+        if self.zygote_scope:
+            await self._start_from_zygote(
+                cmd + args, working_dir, env, unit_properties, uid, gid
+            )
+        else:
+            await self._systemd.start_transient_service(
+                self.unit_name,
+                cmd=cmd,
+                args=args,
+                working_dir=working_dir,
+                environment_variables=env,
+                properties=properties,
+                uid=uid,
+                gid=gid,
+                slice=self.slice,
+            )
 
         for i in range(self.start_timeout):
-            is_up = await self.poll()
-            if is_up is None:
-                return (self.ip or "127.0.0.1", self.port)
+            # not using poll(), as it considers the unit running if systemd is
+            # unresponsive
+            if await self._systemd.service_running(self._systemd_unit_name):
+                self.log.info(
+                    "user:%s Started unit %s in %.2fs",
+                    self.user.name,
+                    self._systemd_unit_name,
+                    time.time() - self._start_time,
+                )
+                await self._watch_memory_events()
+                # spawn_cpu_weight is kept until the server responds, which
+                # is after it has imported its modules
+                ip = self.ip or "127.0.0.1"
+                self._ready_task = asyncio.ensure_future(
+                    self._measure_ready(ip, self.port, self._start_time)
+                )
+                return (ip, self.port)
             await asyncio.sleep(1)
 
         return None
 
+    async def _measure_ready(self, ip, port, start_time):
+        """
+        Wait for the started user server to respond to HTTP requests, and
+        record the time since start() was called.
+
+        Unlike the time until the unit is active, this includes the time the
+        server spends importing modules, which starting from the zygote saves.
+
+        The unit's CPUWeight is then changed from spawn_cpu_weight, otherwise
+        it is changed by the next poll().
+        """
+        mode = "zygote" if self.zygote_scope else "service"
+        base_url = self.server.base_url if self.server else "/"
+        # with internal_ssl, the hub's own check is the only one able to connect
+        if self.internal_ssl:
+            return
+        try:
+            await wait_for_http_server(
+                f"http://{ip}:{port}{base_url}", timeout=self.http_timeout
+            )
+        except asyncio.TimeoutError:
+            return
+        duration = time.time() - start_time
+        SERVER_READY_DURATION_SECONDS.labels(mode).observe(duration)
+        self.log.info(
+            "user:%s Server ready in %.2fs, started as %s",
+            self.user.name,
+            duration,
+            mode,
+        )
+        await self._update_cpu_weight()
+
+    def _zygote_supported(self, properties):
+        """
+        Return True if a unit with given properties can be started from a
+        zygote, logging why not otherwise.
+        """
+        if self.broker_socket:
+            self.log.warning(
+                "user:%s Not starting from zygote, as the broker doesn't start units running as root",
+                self.user.name,
+            )
+            return False
+        unsupported = [
+            key
+            for key in properties
+            if key != "NoNewPrivileges"
+            and not key.startswith(systemd.RESOURCE_CONTROL_PROPERTY_PREFIXES)
+        ]
+        if unsupported:
+            self.log.warning(
+                "user:%s Not starting from zygote, as scopes don't support properties %s",
+                self.user.name,
+                ", ".join(unsupported),
+            )
+            return False
+        return True
+
+    async def _ensure_zygote(self):
+        """
+        Start the zygote of the user's environment profile unless it is already
+        running, and return the path of its socket.
+        """
+        unit_name = ZYGOTE_UNIT_NAME_TEMPLATE.format(
+            profile=self.environment_profile or "default"
+        )
+        socket_path = os.path.join(systemd.RUN_ROOT, unit_name, "zygote.sock")
+        lock = self._zygote_locks.setdefault(unit_name, asyncio.Lock())
+        async with lock:
+            if await self._systemd.service_running(unit_name):
+                return socket_path
+            if await self._systemd.service_failed(unit_name):
+                await self._systemd.reset_service(unit_name)
+
+            self.log.info("Starting zygote unit %s", unit_name)
+            profile = self.environment_profiles.get(self.environment_profile, {})
+            path = profile.get("extra_paths", []) + [os.environ.get("PATH", os.defpath)]
+            cmd = [self.zygote_python, zygote.__file__, "--socket", socket_path]
+            for module in self.zygote_preload_modules:
+                cmd += ["--preload", module]
+            await self._systemd.start_transient_service(
+                unit_name,
+                cmd=cmd,
+                args=[],
+                working_dir="/",
+                environment_variables={"PATH": ":".join(path)},
+                properties=self._environment_profile_properties(
+                    profile, await self._get_capabilities()
+                ),
+            )
+
+            # wait for the zygote to have imported its modules and be listening
+            for i in range(self.start_timeout * 10):
+                try:
+                    await zygote.zygote_request(socket_path, {"action": "ping"})
+                    return socket_path
+                except OSError:
+                    await asyncio.sleep(0.1)
+            raise TimeoutError(f"Zygote unit {unit_name} didn't start listening")
+
+    async def read_pressure(self):
+        """
+        Return a snapshot of the pressure of the node, and of the slice if set,
+        as a dict like {("node", "memory"): {"some": {"avg10": 1.5, ...}}}.
+
+        The some and full avg10 values are also exposed as metrics.
+        """
+        SystemdSpawner._pressure_read_at = time.monotonic()
+        paths = {
+            ("node", resource): os.path.join(cgroups.PROC_PRESSURE_ROOT, resource)
+            for resource in PRESSURE_RESOURCES
+        }
+        if self.slice:
+            try:
+                properties = await self._systemd.service_properties(
+                    self.slice, "ControlGroup"
+                )
+            except (systemd.SystemdUnavailable, TimeoutError):
+                properties = {}
+            if properties.get("ControlGroup"):
+                for resource in PRESSURE_RESOURCES:
+                    paths[("slice", resource)] = cgroups.cgroup_path(
+                        properties["ControlGroup"], f"{resource}.pressure"
+                    )
+
+        snapshot = {}
+        for (scope, resource), path in paths.items():
+            try:
+                pressure = cgroups.read_pressure(path)
+            except OSError:
+                # no cgroup v2, or no pressure for this resource
+                continue
+            snapshot[(scope, resource)] = pressure
+            for kind, values in pressure.items():
+                PRESSURE.labels(scope=scope, resource=resource, kind=kind).set(
+                    values["avg10"]
+                )
+        return snapshot
+
+    def _pressure_exceeded(self, snapshot):
+        """
+        Return descriptions of pressures in snapshot above
+        spawn_pressure_thresholds.
+        """
+        exceeded = []
+        for (scope, resource), pressure in sorted(snapshot.items()):
+            threshold = self.spawn_pressure_thresholds.get(resource)
+            avg10 = pressure.get("some", {}).get("avg10", 0)
+            if threshold is not None and avg10 > threshold:
+                exceeded.append(f"{scope} {resource} {avg10:.0f}% > {threshold}%")
+        return exceeded
+
+    async def _refresh_pressure(self):
+        """
+        Read pressure to keep the pressure metrics current between spawns, at
+        most every PRESSURE_CHECK_INTERVAL seconds across all spawners.
+        """
+        if time.monotonic() - self._pressure_read_at < PRESSURE_CHECK_INTERVAL:
+            return
+        caps = await self._get_capabilities()
+        if caps["pressure"]:
+            await self.read_pressure()
+
+    async def _wait_for_pressure(self):
+        """
+        Wait for pressure to be below spawn_pressure_thresholds, up to
+        spawn_pressure_timeout seconds.
+        """
+        deadline = time.monotonic() + self.spawn_pressure_timeout
+        delayed = False
+        try:
+            while True:
+                snapshot = await self.read_pressure()
+                exceeded = self._pressure_exceeded(snapshot)
+                if not exceeded:
+                    if delayed:
+                        SPAWNS_DELAYED_BY_PRESSURE.labels(outcome="started").inc()
+                    return
+                if time.monotonic() >= deadline:
+                    SPAWNS_DELAYED_BY_PRESSURE.labels(outcome="rejected").inc()
+                    raise RuntimeError(
+                        f"Not starting server, the server's machine is too busy: {', '.join(exceeded)}"
+                    )
+                if not delayed:
+                    self.log.info(
+                        "user:%s Delaying spawn due to pressure: %s",
+                        self.user.name,
+                        ", ".join(exceeded),
+                    )
+                    delayed = True
+                self._pressure_message = f"Waiting for the server's machine to be less busy: {', '.join(exceeded)}"
+                await asyncio.sleep(PRESSURE_CHECK_INTERVAL)
+        finally:
+            self._pressure_message = None
+
+    async def _start_from_zygote(self, argv, working_dir, env, properties, uid, gid):
+        """
+        Fork the user server from a zygote and move it into a transient scope
+        unit with given resource control properties, before letting it run.
+        """
+        socket_path = await self._ensure_zygote()
+        scope_name = f"{self.unit_name}.scope"
+        if await self._systemd.service_running(scope_name):
+            await self._systemd.stop_service(scope_name)
+        if await self._systemd.service_failed(scope_name):
+            await self._systemd.reset_service(scope_name)
+
+        # set by systemd for services with a User=, but not by a zygote
+        pw = pwd.getpwuid(uid)
+        env = {"HOME": pw.pw_dir, "USER": pw.pw_name, "LOGNAME": pw.pw_name, **env}
+        response = await zygote.zygote_request(
+            socket_path,
+            {
+                "action": "fork",
+                "uid": uid,
+                "gid": gid,
+                "working_dir": working_dir,
+                "env": env,
+                "argv": argv,
+                "no_new_privileges": properties.get("NoNewPrivileges") == "yes",
+            },
+        )
+        pid = response["pid"]
+        properties = {k: v for k, v in properties.items() if k != "NoNewPrivileges"}
+        try:
+            await self._systemd.start_transient_scope(
+                scope_name, [pid], properties=properties, slice=self.slice
+            )
+        except Exception:
+            await zygote.zygote_request(socket_path, {"action": "abort", "pid": pid})
+            raise
+        await zygote.zygote_request(socket_path, {"action": "release", "pid": pid})
+
+    @staticmethod
+    def _reflink_probe_command(source, scratch):
+        """
+        Return the command cloning the file source to scratch with a reflink,
+        which fails if the filesystems don't support it. scratch is removed
+        either way, as cp leaves an empty file if cloning fails.
+        """
+        return [
+            "sh",
+            "-c",
+            'cp --reflink=always -- "$1" "$2"; status=$?; rm -f -- "$2"; exit $status',
+            "sh",
+            source,
+            scratch,
+        ]
+
+    @staticmethod
+    def _home_seeding_command(template, home):
+        """
+        Return the command copying the template into home, with reflinks where
+        supported, without overwriting files the user has already created.
+
+        cp --no-clobber fails when skipping existing files since coreutils 9.2,
+        so --update=none is used where available, which was added in 9.3 to
+        skip them without failing.
+
+        ref: https://git.savannah.gnu.org/cgit/coreutils.git/tree/NEWS
+        """
+        return [
+            "sh",
+            "-c",
+            "if cp --update=none --version >/dev/null 2>&1; then skip=--update=none; else skip=--no-clobber; fi; "
+            'exec cp --recursive "$skip" --preserve=mode,timestamps,links --reflink=auto -- "$1" "$2"',
+            "sh",
+            os.path.join(template, "."),
+            home,
+        ]
+
+    async def _run_home_seeding(self, seed_unit, command):
+        """
+        Start command in the dynamic user's state directory, as the dynamic
+        user in its own service.
+        """
+        if await self._systemd.service_failed(seed_unit):
+            await self._systemd.reset_service(seed_unit)
+        await self._systemd.start_transient_service(
+            seed_unit,
+            cmd=command[:1],
+            args=command[1:],
+            working_dir="/",
+            properties={
+                # the same dynamic user as the user's unit, which is named
+                # after the unit if User= isn't set
+                #
+                # ref: https://www.freedesktop.org/software/systemd/man/systemd.exec.html#DynamicUser=
+                #
+                "DynamicUser": "yes",
+                "User": self.unit_name,
+                "StateDirectory": self._expand_user_vars("{USERNAME}"),
+            },
+            slice=self.slice,
+        )
+
+    async def _wait_for_home_seeding(self, seed_unit):
+        """
+        Wait for seed_unit to complete, and return true if it succeeded.
+        """
+        while await self._systemd.service_running(seed_unit):
+            await asyncio.sleep(HOME_SEEDING_POLL_INTERVAL)
+        # a successfully completed transient service is unloaded, a failed one
+        # is kept in the failed state
+        return not await self._systemd.service_failed(seed_unit)
+
+    async def _seed_home(self):
+        """
+        Populate the dynamic user's home directory from home_template, before
+        the user server starts if reflinks are supported, and otherwise with a
+        copy in the background.
+        """
+        seed_unit = f"{self.unit_name}-seed-home"
+        template = self._expand_user_vars(self.home_template)
+        home = f"/var/lib/{self._expand_user_vars('{USERNAME}')}/"
+        start_time = time.time()
+
+        # whether reflinks are supported is probed by cloning a single file, as
+        # cp --reflink=always leaves empty files behind when it fails
+        reflink = False
+        probe_file = self._home_template_probe_file(template)
+        if probe_file:
+            await self._run_home_seeding(
+                seed_unit,
+                self._reflink_probe_command(
+                    probe_file, os.path.join(home, ".systemdspawner-reflink-probe")
+                ),
+            )
+            reflink = await self._wait_for_home_seeding(seed_unit)
+
+        await self._run_home_seeding(
+            seed_unit, self._home_seeding_command(template, home)
+        )
+        if reflink:
+            if await self._wait_for_home_seeding(seed_unit):
+                self._home_seeded("reflink", time.time() - start_time)
+            else:
+                self._home_seeding_failed(seed_unit)
+            return
+
+        self.log.debug(
+            "user:%s Filesystem doesn't support reflinks, copying home in the background",
+            self.user.name,
+        )
+        self.home_seeded = True
+        self._home_seeding_task = asyncio.ensure_future(
+            self._finish_home_seeding(seed_unit, start_time)
+        )
+
+    @staticmethod
+    def _home_template_probe_file(template):
+        """
+        Return the path of a regular file in template, or None.
+        """
+        for dirpath, dirnames, filenames in os.walk(template):
+            for filename in filenames:
+                path = os.path.join(dirpath, filename)
+                if os.path.isfile(path) and not os.path.islink(path):
+                    return path
+        return None
+
+    async def _finish_home_seeding(self, seed_unit, start_time):
+        try:
+            succeeded = await self._wait_for_home_seeding(seed_unit)
+        except (systemd.SystemdUnavailable, TimeoutError) as e:
+            self.log.warning(
+                "user:%s Failed to check if home was seeded: %s", self.user.name, e
+            )
+            return
+        if succeeded:
+            self._home_seeded("copy", time.time() - start_time)
+        else:
+            self._home_seeding_failed(seed_unit)
+
+    def _home_seeding_failed(self, seed_unit):
+        self.log.warning(
+            "user:%s Failed to seed home from %s, see the journal of unit %s",
+            self.user.name,
+            self.home_template,
+            seed_unit,
+        )
+        # try again on the next spawn
+        self.home_seeded = False
+
+    def _home_seeded(self, method, duration):
+        self.home_seeded = True
+        HOME_SEEDING_DURATION_SECONDS.labels(method).observe(duration)
+        self.log.info(
+            "user:%s Seeded home from %s in %.2fs with %s",
+            self.user.name,
+            self.home_template,
+            duration,
+            method,
+        )
+
     async def stop(self, now=False):
-        await systemd.stop_service(self.unit_name)
+        # the spawner is reused for the next spawn, whose progress() may run
+        # before start() and must not replay this server's journal
+        self._start_time = None
+        if self._ready_task is not None:
+            self._ready_task.cancel()
+            self._ready_task = None
+        self._unwatch_memory_events()
+        await self._systemd.stop_service(self._systemd_unit_name)
+        self._release_port()
 
     async def poll(self):
-        if await systemd.service_running(self.unit_name):
+        try:
+            running = await self._systemd.service_running(self._systemd_unit_name)
+        except (systemd.SystemdUnavailable, TimeoutError) as e:
+            # an unresponsive systemd doesn't mean the user server has stopped,
+            # so we don't let the hub consider it stopped
+            self.log.warning(
+                "user:%s Assuming unit %s is running, as systemd is unresponsive: %s",
+                self.user.name,
+                self._systemd_unit_name,
+                e,
+            )
+            return None
+        if running:
+            # after a hub restart, the unit's memory events aren't yet watched
+            await self._watch_memory_events()
+            await self._update_cpu_weight()
+            self._measure_log_namespace()
+            await self._refresh_pressure()
             return None
+        self._unwatch_memory_events()
         return 1
+
+    def _get_cpu_weight(self, batch=False):
+        """
+        Return the CPUWeight for the user's unit with cpu_policy "weight".
+        """
+        if batch and self.cpu_batch_weight is not None:
+            return self.cpu_batch_weight
+        cpu_guarantee = 1 if self.cpu_guarantee is None else self.cpu_guarantee
+        # CPUWeight must be between 1 and 10000
+        return min(max(round(cpu_guarantee * self.cpu_weight_per_cpu), 1), 10000)
+
+    def _seconds_since_activity(self):
+        """
+        Return seconds since the user server's last activity, or None.
+        """
+        last_activity = getattr(self.orm_spawner, "last_activity", None)
+        if last_activity is None:
+            return None
+        if last_activity.tzinfo is None:
+            # the hub's database stores naive UTC datetimes
+            last_activity = last_activity.replace(tzinfo=timezone.utc)
+        return (datetime.now(timezone.utc) - last_activity).total_seconds()
+
+    async def _update_cpu_weight(self):
+        """
+        Set the CPUWeight of the running unit, if it should change as the user
+        server has started, or become active or inactive.
+        """
+        if self.cpu_policy != "weight":
+            return
+        idle = self._seconds_since_activity()
+        batch = idle is not None and idle >= self.cpu_batch_after
+        cpu_weight = self._get_cpu_weight(batch=batch)
+        if cpu_weight == self._cpu_weight:
+            return
+        try:
+            await self._systemd.set_service_properties(
+                self._systemd_unit_name, {"CPUWeight": cpu_weight}
+            )
+        except Exception as e:
+            self.log.warning(
+                "user:%s Failed to set CPUWeight of unit %s: %s",
+                self.user.name,
+                self._systemd_unit_name,
+                e,
+            )
+            return
+        self.log.debug(
+            "user:%s Set CPUWeight of unit %s to %s",
+            self.user.name,
+            self._systemd_unit_name,
+            cpu_weight,
+        )
+        self._cpu_weight = cpu_weight
+
+    async def _watch_memory_events(self):
+        """
+        Start watching the memory.events of the user's unit, unless already
+        watching or disabled.
+        """
+        if not self.monitor_memory_events or self._memory_events_wd is not None:
+            return
+        caps = await self._get_capabilities()
+        if caps["cgroup_version"] != 2:
+            return
+        try:
+            properties = await self._systemd.service_properties(
+                self._systemd_unit_name, "ControlGroup"
+            )
+        except (systemd.SystemdUnavailable, TimeoutError):
+            # tried again on the next poll
+            return
+        if not properties.get("ControlGroup"):
+            return
+        path = cgroups.cgroup_path(properties["ControlGroup"], "memory.events")
+        try:
+            self._memory_events_last = cgroups.read_flat_keyed(path)
+            self._memory_events_wd = cgroups.get_watcher().watch(
+                path, functools.partial(self._memory_events_changed, path)
+            )
+        except OSError as e:
+            self.log.warning(
+                "user:%s Failed to watch memory events of unit %s: %s",
+                self.user.name,
+                self._systemd_unit_name,
+                e,
+            )
+
+    def _unwatch_memory_events(self):
+        if self._memory_events_wd is not None:
+            cgroups.get_watcher().unwatch(self._memory_events_wd)
+            self._memory_events_wd = None
+
+    def _memory_events_changed(self, path):
+        """
+        Record the memory events that have occurred since memory.events was
+        last read.
+        """
+        try:
+            counts = cgroups.read_flat_keyed(path)
+        except OSError:
+            # the unit's cgroup has been removed
+            return
+        events = {
+            key: count - self._memory_events_last.get(key, 0)
+            for key, count in counts.items()
+            if count > self._memory_events_last.get(key, 0)
+        }
+        self._memory_events_last = counts
+        if not events:
+            return
+
+        for key, increase in events.items():
+            self.memory_events[key] = self.memory_events.get(key, 0) + increase
+            MEMORY_EVENTS.labels(event=key).inc(increase)
+        if "oom_kill" in events:
+            self.log.warning(
+                "user:%s %s process(es) in unit %s killed for running out of memory, mem_limit is %s",
+                self.user.name,
+                events["oom_kill"],
+                self._systemd_unit_name,
+                self.mem_limit,
+            )
+        else:
+            self.log.debug(
+                "user:%s Memory events in unit %s: %s",
+                self.user.name,
+                self._systemd_unit_name,
+                events,
+            )
+
+        if self.memory_event_hook:
+            try:
+                result = self.memory_event_hook(self, events)
+                if inspect.isawaitable(result):
+                    task = asyncio.ensure_future(result)
+                    self._memory_event_hook_tasks.add(task)
+                    task.add_done_callback(self._memory_event_hook_done)
+            except Exception:
+                self.log.exception("memory_event_hook failed with exception: %s", self)
+
+    def _memory_event_hook_done(self, task):
+        self._memory_event_hook_tasks.discard(task)
+        if not task.cancelled() and task.exception() is not None:
+            self.log.error(
+                "memory_event_hook failed with exception: %s",
+                self,
+                exc_info=task.exception(),
+            )
+
+    async def progress(self):
+        """
+        Yield spawn progress events while the user server is starting.
+
+        The unit's journal is followed from when start() was called, or from
+        now if start() hasn't been called yet, and unit state transitions and
+        recognised log lines from the user server are mapped to progress
+        milestones. Only events that increase the progress are yielded, so a
+        chatty unit can't flood the hub with events, and the journal is no
+        longer followed once the server is reported running.
+
+        While the spawn is delayed by spawn_pressure_thresholds, the reason is
+        yielded whenever it changes.
+        """
+        progress = 0
+        state_checked = 0
+        pressure_message = None
+        # start() only sets the namespace of the unit after awaiting systemd,
+        # while progress() is called as soon as the spawn is pending
+        namespace = self._log_namespace
+        if namespace is None and self.log_namespace is not None:
+            namespace = self._get_log_namespace(await self._get_capabilities())
+        journal = None
+        try:
+            while True:
+                # start() only decides late whether the server runs in a scope
+                # forked from the zygote, the journal is then followed again
+                unit_name = self._systemd_unit_name
+                journal = systemd.follow_journal(
+                    unit_name,
+                    since=self._start_time,
+                    idle_timeout=1,
+                    namespace=namespace,
+                )
+                async for line in journal:
+                    if self._systemd_unit_name != unit_name:
+                        break
+                    event = None
+                    if line is None or time.monotonic() - state_checked >= 1:
+                        state_checked = time.monotonic()
+                        try:
+                            properties = await self._systemd.service_properties(
+                                unit_name, "ActiveState"
+                            )
+                        except (systemd.SystemdUnavailable, TimeoutError):
+                            properties = {}
+                        active_state = properties.get("ActiveState")
+                        if active_state == "failed":
+                            yield {
+                                "progress": progress,
+                                "message": f"Systemd unit {unit_name} failed",
+                            }
+                            return
+                        event = UNIT_STATE_PROGRESS.get(active_state)
+                    if line:
+                        for pattern, line_progress, message in SERVER_LOG_PROGRESS:
+                            if pattern.search(line):
+                                event = max(event or (0, ""), (line_progress, message))
+                                break
+                    if self._pressure_message != pressure_message:
+                        pressure_message = self._pressure_message
+                        if pressure_message:
+                            yield {"progress": progress, "message": pressure_message}
+                    if event and event[0] > progress:
+                        progress, message = event
+                        yield {"progress": progress, "message": message}
+                    if progress >= SERVER_READY_PROGRESS:
+                        return
+                else:
+                    return
+                await journal.aclose()
+        finally:
+            if journal is not None:
+                await journal.aclose()
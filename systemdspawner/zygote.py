@@ -0,0 +1,257 @@
+"""
+Zygote process for fast user server startup.
+
+A zygote is a long-lived privileged process that imports the Python modules
+needed by user servers once, and then forks a child for each user server that
+starts with those modules already imported. Each child drops privileges to the
+user's uid / gid and waits until the hub has moved it into the user's systemd
+scope before running the user server.
+
+This module is run as a script by the zygote's own systemd unit, in whatever
+Python environment the user servers should use, and must therefore only depend
+on the standard library.
+
+The hub talks to the zygote over a Unix socket, sending one newline-terminated
+JSON request per connection and receiving one JSON response.
+"""
+
+import argparse
+import asyncio
+import ctypes
+import importlib
+import importlib.metadata
+import json
+import os
+import pwd
+import signal
+import site
+import socket
+import sys
+import traceback
+
+# jupyterhub.singleuser isn't preloaded by default, as it chooses the server
+# application when imported, see SINGLEUSER_IMPORT_ENV
+DEFAULT_PRELOAD_MODULES = [
+    "jupyter_server.serverapp",
+    "tornado.web",
+    "zmq",
+]
+
+# environment variables jupyterhub.singleuser reads when imported, to choose the
+# server application and whether to run as a server extension
+SINGLEUSER_IMPORT_ENV = [
+    "JUPYTERHUB_SINGLEUSER_APP",
+    "JUPYTERHUB_SINGLEUSER_EXTENSION",
+]
+
+JOURNAL_STDOUT_SOCKET = "/run/systemd/journal/stdout"
+
+# ref: https://man7.org/linux/man-pages/man2/PR_SET_NO_NEW_PRIVS.2const.html
+PR_SET_NO_NEW_PRIVS = 38
+
+
+async def zygote_request(socket_path, request):
+    """
+    Send a request to the zygote listening on socket_path, and return its
+    response.
+
+    Raises RuntimeError if the zygote responds with an error.
+    """
+    reader, writer = await asyncio.open_unix_connection(socket_path)
+    try:
+        writer.write(json.dumps(request).encode("utf8") + b"\n")
+        await writer.drain()
+        response = json.loads(await reader.readline())
+    finally:
+        writer.close()
+        await writer.wait_closed()
+    if "error" in response:
+        raise RuntimeError(f"Zygote at {socket_path} failed: {response['error']}")
+    return response
+
+
+def preload(modules):
+    """
+    Import given modules, reporting but otherwise ignoring failures.
+    """
+    for module in modules:
+        try:
+            importlib.import_module(module)
+        except Exception as e:
+            print(f"Failed to preload {module}: {e}", file=sys.stderr, flush=True)
+
+
+def preloaded_for_env(env):
+    """
+    Return False if preloaded modules were imported with values of the
+    environment variables they read when imported that differ from env, so
+    that they would behave differently than if imported by the user server.
+    """
+    if "jupyterhub.singleuser" not in sys.modules:
+        return True
+    return all(
+        env.get(name, "") == os.environ.get(name, "") for name in SINGLEUSER_IMPORT_ENV
+    )
+
+
+def connect_journal(identifier):
+    """
+    Connect stdout and stderr to a new journal stream.
+
+    journald attributes a stream to the systemd unit of the process connecting
+    to it, so this makes the output of a child show up in the journal of the
+    scope it has been moved to, instead of the zygote's.
+
+    ref: https://www.freedesktop.org/software/systemd/man/sd_journal_stream_fd.html
+    """
+    try:
+        sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        sock.connect(JOURNAL_STDOUT_SOCKET)
+    except OSError:
+        # no journald to connect to, keep the inherited stdout and stderr
+        return
+    sock.shutdown(socket.SHUT_RD)
+    # identifier, unit id, priority, level prefix, forward to syslog, kmsg
+    # and console
+    sock.sendall(f"{identifier}\n\n6\n0\n0\n0\n0\n".encode("utf8"))
+    sys.stdout.flush()
+    sys.stderr.flush()
+    os.dup2(sock.fileno(), 1)
+    os.dup2(sock.fileno(), 2)
+    sock.close()
+
+
+def run_child(request, release_fd):
+    """
+    Become the user server described by request, never returning.
+    """
+    signal.signal(signal.SIGCHLD, signal.SIG_DFL)
+    signal.signal(signal.SIGTERM, signal.SIG_DFL)
+    os.setsid()
+
+    uid = request["uid"]
+    gid = request["gid"]
+    os.initgroups(pwd.getpwuid(uid).pw_name, gid)
+    os.setgid(gid)
+    os.setuid(uid)
+    if request.get("no_new_privileges"):
+        libc = ctypes.CDLL(None, use_errno=True)
+        if libc.prctl(PR_SET_NO_NEW_PRIVS, 1, 0, 0, 0) != 0:
+            os._exit(1)
+
+    os.chdir(request["working_dir"])
+    preloaded = preloaded_for_env(request["env"])
+    os.environ.clear()
+    os.environ.update(request["env"])
+    # the user's site-packages were resolved for the zygote's user on startup
+    site.USER_BASE = site.USER_SITE = None
+    if site.ENABLE_USER_SITE and os.path.isdir(site.getusersitepackages()):
+        site.addsitedir(site.getusersitepackages())
+
+    # wait for the hub to move us into the user's scope, an empty read means
+    # the zygote has gone away without releasing us
+    if os.read(release_fd, 1) != b"1":
+        os._exit(1)
+    os.close(release_fd)
+    connect_journal(os.path.basename(request["argv"][0]))
+
+    argv = request["argv"]
+    entry_points = importlib.metadata.entry_points(
+        group="console_scripts", name=os.path.basename(argv[0])
+    )
+    if not entry_points or not preloaded:
+        # not a preloadable Python console script, or preloaded for another
+        # environment, nothing to gain from the zygote except starting in the
+        # user's scope
+        os.execvpe(argv[0], argv, os.environ)
+
+    main = next(iter(entry_points)).load()
+    sys.argv = argv
+    try:
+        code = main()
+    except SystemExit as e:
+        code = e.code
+    except BaseException:
+        traceback.print_exc()
+        code = 1
+    sys.stdout.flush()
+    sys.stderr.flush()
+    os._exit(code if isinstance(code, int) else 0 if code is None else 1)
+
+
+class Zygote:
+    def __init__(self, socket_path):
+        self.socket_path = socket_path
+        # pid -> write end of the pipe a forked child waits on to be released
+        self.pending = {}
+
+    def handle_fork(self, request):
+        release_r, release_w = os.pipe()
+        pid = os.fork()
+        if pid == 0:
+            try:
+                # don't leak the zygote's sockets and other children's pipes
+                os.closerange(3, release_r)
+                os.closerange(release_r + 1, os.sysconf("SC_OPEN_MAX"))
+                run_child(request, release_r)
+            finally:
+                os._exit(1)
+        os.close(release_r)
+        self.pending[pid] = release_w
+        return {"pid": pid}
+
+    def handle_release(self, request):
+        release_w = self.pending.pop(request["pid"])
+        os.write(release_w, b"1")
+        os.close(release_w)
+        return {}
+
+    def handle_abort(self, request):
+        os.close(self.pending.pop(request["pid"]))
+        return {}
+
+    def handle_ping(self, request):
+        return {}
+
+    def serve(self):
+        # children are reaped automatically, they reset this after forking
+        signal.signal(signal.SIGCHLD, signal.SIG_IGN)
+        if os.path.exists(self.socket_path):
+            os.unlink(self.socket_path)
+        sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        sock.bind(self.socket_path)
+        os.chmod(self.socket_path, 0o600)
+        sock.listen()
+        while True:
+            conn, _ = sock.accept()
+            with conn:
+                try:
+                    request = json.loads(conn.makefile("rb").readline())
+                    handler = getattr(self, f"handle_{request['action']}")
+                    response = handler(request)
+                except Exception as e:
+                    response = {"error": f"{type(e).__name__}: {e}"}
+                # a forked child never gets here
+                conn.sendall(json.dumps(response).encode("utf8") + b"\n")
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.split("\n\n")[0])
+    parser.add_argument("--socket", required=True, help="Unix socket to listen on")
+    parser.add_argument(
+        "--preload",
+        action="append",
+        help="Module to import before forking, can be given multiple times",
+    )
+    args = parser.parse_args()
+    # this script's directory is systemdspawner's package directory, and its
+    # modules shouldn't shadow top-level modules when preloading
+    script_dir = os.path.dirname(os.path.abspath(__file__))
+    if sys.path and os.path.abspath(sys.path[0]) == script_dir:
+        del sys.path[0]
+    preload(args.preload or DEFAULT_PRELOAD_MODULES)
+    Zygote(args.socket).serve()
+
+
+if __name__ == "__main__":
+    main()
@@ -59,3 +59,17 @@ async def systemdspawner_config():
     config.JupyterHub.cookie_secret = "abc123"
 
     return config
+
+
+@pytest.fixture
+def spawner():
+    """
+    Represents a SystemdSpawner for a user, created without a JupyterHub app to
+    test its methods in isolation.
+    """
+    from types import SimpleNamespace
+
+    from systemdspawner import SystemdSpawner
+
+    user = SimpleNamespace(name="testuser", id=1000, url="/user/testuser/")
+    return SystemdSpawner(user=user)
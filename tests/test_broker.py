@@ -0,0 +1,267 @@
+"""
+Test the broker and its client, with a fake systemd module.
+"""
+import asyncio
+import os
+import pwd
+from types import SimpleNamespace
+
+import pytest
+
+from systemdspawner import broker, cgroups, systemd
+
+
+@pytest.fixture
+def fake_systemd():
+    calls = []
+
+    async def services_running(unit_names):
+        calls.append(("services_running", unit_names))
+        return {
+            unit_name: unit_name.startswith("jupyter-running")
+            for unit_name in unit_names
+        }
+
+    async def service_properties(unit_name, *names):
+        calls.append(("service_properties", unit_name, names))
+        return {name: f"{unit_name}-{name}" for name in names}
+
+    async def stop_service(unit_name):
+        calls.append(("stop_service", unit_name))
+        # slow, to test that requests after it don't wait for it
+        await asyncio.sleep(0.5)
+
+    async def service_failed(unit_name):
+        raise systemd.SystemdUnavailable("systemd is unhealthy")
+
+    async def reset_service(unit_name):
+        raise ValueError("unexpected")
+
+    async def start_transient_service(
+        unit_name,
+        cmd,
+        args,
+        working_dir,
+        environment_variables=None,
+        properties=None,
+        uid=None,
+        gid=None,
+        slice=None,
+    ):
+        calls.append(("start_transient_service", unit_name, properties))
+
+    fake = SimpleNamespace(
+        calls=calls,
+        services_running=services_running,
+        service_properties=service_properties,
+        stop_service=stop_service,
+        service_failed=service_failed,
+        reset_service=reset_service,
+        start_transient_service=start_transient_service,
+    )
+    for name in broker.OPERATIONS:
+        if not hasattr(fake, name):
+            setattr(fake, name, None)
+    return fake
+
+
+@pytest.fixture
+def users(monkeypatch):
+    """
+    Fake users, alice and bob, who is a member of the privileged group 27.
+    """
+    users = {
+        1000: SimpleNamespace(pw_name="alice", pw_gid=1000),
+        1001: SimpleNamespace(pw_name="bob", pw_gid=1001),
+    }
+    groups = {"alice": [1000], "bob": [1001, 27]}
+    monkeypatch.setattr(pwd, "getpwuid", lambda uid: users[uid])
+    monkeypatch.setattr(os, "getgrouplist", lambda name, gid: [gid] + groups[name])
+
+
+@pytest.fixture
+async def client(fake_systemd, users, tmp_path):
+    socket_path = str(tmp_path / "broker.sock")
+    server = await asyncio.start_unix_server(
+        broker.Broker(
+            fake_systemd, allowed_uids={os.getuid()}, privileged_gids={27}
+        ).handle_connection,
+        socket_path,
+    )
+    yield broker.BrokerClient(socket_path)
+    server.close()
+
+
+async def test_batch_service_running(client, fake_systemd):
+    """
+    Test that concurrent service_running requests are batched into one call.
+    """
+    running = await asyncio.gather(
+        client.service_running("jupyter-running-a"),
+        client.service_running("jupyter-stopped-b"),
+        client.service_running("jupyter-running-a"),
+    )
+    assert running == [True, False, True]
+    assert fake_systemd.calls == [
+        ("services_running", ["jupyter-running-a", "jupyter-stopped-b"])
+    ]
+
+
+async def test_pipelined(client, fake_systemd):
+    """
+    Test that requests are answered without waiting for slower ones sent
+    before them over the same connection.
+    """
+    stop = asyncio.ensure_future(client.stop_service("jupyter-unit"))
+    properties = await asyncio.wait_for(
+        client.service_properties("jupyter-unit", "MainPID"), 0.4
+    )
+    assert properties == {"MainPID": "jupyter-unit-MainPID"}
+    assert not stop.done()
+    await stop
+
+
+async def test_errors(client):
+    with pytest.raises(systemd.SystemdUnavailable):
+        await client.service_failed("jupyter-unit")
+    with pytest.raises(broker.BrokerError, match="unexpected"):
+        await client.reset_service("jupyter-unit")
+    with pytest.raises(broker.BrokerError, match="Unknown operation"):
+        await client.request("count_journal_entries", "jupyter-unit")
+    with pytest.raises(AttributeError):
+        client.follow_journal
+
+
+async def test_broker_unreachable(tmp_path):
+    client = broker.BrokerClient(str(tmp_path / "missing.sock"))
+    with pytest.raises(systemd.SystemdUnavailable):
+        await client.service_running("jupyter-unit")
+
+
+async def test_peer_not_allowed(fake_systemd, tmp_path):
+    socket_path = str(tmp_path / "broker.sock")
+    server = await asyncio.start_unix_server(
+        broker.Broker(fake_systemd, allowed_uids=set()).handle_connection,
+        socket_path,
+    )
+    client = broker.BrokerClient(socket_path)
+    with pytest.raises(systemd.SystemdUnavailable, match="lost"):
+        await client.service_running("jupyter-running-a")
+    server.close()
+
+
+@pytest.mark.parametrize(
+    "unit_name, kwargs, error",
+    [
+        ("jupyter-a-singleuser", {"uid": 1000}, None),
+        ("jupyter-a-singleuser", {"uid": 1000, "gid": 1000}, None),
+        (
+            "jupyter-a-singleuser",
+            {
+                "uid": 1000,
+                "properties": {"MemoryMax": "1G", "NoNewPrivileges": "no"},
+            },
+            None,
+        ),
+        (
+            "jupyter-a-singleuser-seed-home",
+            {"properties": {"DynamicUser": "yes", "User": "jupyter-a-singleuser"}},
+            None,
+        ),
+        ("sshd", {"uid": 1000}, "prefixes jupyter-"),
+        ("jupyter-../../etc", {"uid": 1000}, "prefixes jupyter-"),
+        ("jupyter-a-singleuser", {}, "would run as root"),
+        ("jupyter-a-singleuser", {"uid": 0}, "isn't in the range"),
+        ("jupyter-a-singleuser", {"uid": 70000}, "isn't in the range"),
+        ("jupyter-a-singleuser", {"uid": 1002}, "No user"),
+        ("jupyter-a-singleuser", {"uid": 1000, "gid": 0}, "privileged groups"),
+        ("jupyter-a-singleuser", {"uid": 1000, "gid": 27}, "privileged groups"),
+        ("jupyter-a-singleuser", {"uid": 1001}, "privileged groups"),
+        (
+            "jupyter-a-singleuser",
+            {"uid": 1000, "properties": {"User": "root"}},
+            "only allowed with DynamicUser",
+        ),
+        (
+            "jupyter-a-singleuser",
+            {"properties": {"DynamicUser": "yes", "User": "root"}},
+            "Dynamic user root",
+        ),
+        (
+            "jupyter-a-singleuser",
+            {"properties": {"DynamicUser": "yes"}, "uid": 1000},
+            "with a uid",
+        ),
+        (
+            "jupyter-a-singleuser",
+            {"uid": 1000, "properties": {"Group": "sudo"}},
+            "Group",
+        ),
+        (
+            "jupyter-a-singleuser",
+            {"uid": 1000, "properties": {"BindPaths": "/home/u/evil:/etc/sudoers.d"}},
+            "BindPaths",
+        ),
+        (
+            "jupyter-a-singleuser",
+            {"uid": 1000, "properties": {"RootImage": "/home/u/evil.raw"}},
+            "RootImage",
+        ),
+        (
+            "jupyter-a-singleuser",
+            {"uid": 1000, "properties": {"ExecStartPre": "+/bin/sh"}},
+            "ExecStartPre",
+        ),
+    ],
+)
+async def test_check_request(client, fake_systemd, unit_name, kwargs, error):
+    """
+    Test that the broker only manages units with its prefixes, and only starts
+    units with allowed properties as unprivileged users.
+    """
+    request = client.start_transient_service(
+        unit_name, cmd=["jupyterhub-singleuser"], args=[], working_dir="/", **kwargs
+    )
+    if error:
+        with pytest.raises(PermissionError, match=error):
+            await request
+        assert fake_systemd.calls == []
+    else:
+        await request
+        [(op, started_unit_name, properties)] = fake_systemd.calls
+        assert started_unit_name == unit_name
+        # forced, so that setuid executables can't gain privileges
+        assert properties["NoNewPrivileges"] == "yes"
+
+
+async def test_check_request_slice(client, fake_systemd):
+    """
+    Test that the state of slices can be read, but not changed.
+    """
+    properties = await client.service_properties("user.slice", "ControlGroup")
+    assert properties == {"ControlGroup": "user.slice-ControlGroup"}
+    with pytest.raises(PermissionError):
+        await client.stop_service("user.slice")
+    with pytest.raises(PermissionError):
+        await client.set_service_properties("user.slice", {"CPUWeight": 1})
+    with pytest.raises(PermissionError, match="RootImage"):
+        await client.set_service_properties("jupyter-unit", {"RootImage": "/x"})
+
+
+async def test_spawner_slice_pressure(client, fake_systemd, spawner, monkeypatch):
+    """
+    Test that the pressure of the slice of user servers is read through the
+    broker.
+    """
+    read = []
+
+    def read_pressure(path):
+        read.append(path)
+        return {"some": {"avg10": 1.0}}
+
+    monkeypatch.setattr(cgroups, "read_pressure", read_pressure)
+    spawner.broker_socket = client.socket_path
+    spawner.slice = "user.slice"
+    snapshot = await spawner.read_pressure()
+    assert ("service_properties", "user.slice", ("ControlGroup",)) in fake_systemd.calls
+    assert ("slice", "memory") in snapshot
@@ -0,0 +1,71 @@
+"""
+Test probing and persisting systemd and kernel capabilities.
+"""
+import json
+import os
+
+import pytest
+
+from systemdspawner import capabilities, systemd
+
+
+async def test_probe(tmp_path):
+    cache_path = str(tmp_path / "capabilities.json")
+    caps = await capabilities.probe(cache_path)
+    assert isinstance(caps["systemd_version"], int)
+    assert caps["cgroup_version"] in {1, 2}
+
+    with open(cache_path) as f:
+        cache = json.load(f)
+    assert cache["boot_id"] == capabilities.read_boot_id()
+    assert cache["capabilities"] == caps
+
+
+async def test_probe_persisted(tmp_path, monkeypatch):
+    """
+    Test that persisted capabilities are only used for the same boot ID.
+    """
+    cache_path = str(tmp_path / "capabilities.json")
+    persisted = {"systemd_version": 1}
+    capabilities.save_capabilities(cache_path, "boot-1", persisted)
+
+    monkeypatch.setattr(capabilities, "read_boot_id", lambda: "boot-1")
+    assert await capabilities.probe(cache_path) == persisted
+
+    monkeypatch.setattr(capabilities, "read_boot_id", lambda: "boot-2")
+    caps = await capabilities.probe(cache_path)
+    assert caps != persisted
+    assert capabilities.load_capabilities(cache_path, "boot-2") == caps
+
+
+async def test_probe_version_failed(tmp_path, monkeypatch):
+    """
+    Test that capabilities aren't persisted if systemd's version can't be
+    probed, and are probed again after REPROBE_INTERVAL.
+    """
+    probes = []
+
+    async def run_systemd_command(*args, **kwargs):
+        probes.append(args)
+        raise TimeoutError("systemctl --version timed out")
+
+    monkeypatch.setattr(systemd, "run_systemd_command", run_systemd_command)
+    monkeypatch.setattr(capabilities, "_capabilities", None)
+    monkeypatch.setattr(capabilities, "_incomplete", None)
+    monkeypatch.setattr(capabilities, "_probe_task", None)
+    cache_path = str(tmp_path / "capabilities.json")
+
+    with pytest.warns(RuntimeWarning, match="timed out"):
+        caps = await capabilities.get_capabilities(cache_path)
+    assert caps["systemd_version"] is None
+    # unknown, rather than unsupported
+    assert caps["dynamic_user"] is None
+    assert not os.path.exists(cache_path)
+
+    # not probed again until REPROBE_INTERVAL has passed
+    assert await capabilities.get_capabilities(cache_path) == caps
+    assert len(probes) == 1
+    monkeypatch.setattr(capabilities, "REPROBE_INTERVAL", 0)
+    with pytest.warns(RuntimeWarning, match="timed out"):
+        await capabilities.get_capabilities(cache_path)
+    assert len(probes) == 2
@@ -0,0 +1,56 @@
+"""
+Test cgroup utilities, using regular files in place of cgroup interface files.
+"""
+import asyncio
+
+from systemdspawner import cgroups
+
+
+def test_cgroup_path():
+    assert (
+        cgroups.cgroup_path("/system.slice/jupyter-a.service", "memory.events")
+        == "/sys/fs/cgroup/system.slice/jupyter-a.service/memory.events"
+    )
+
+
+def test_read_flat_keyed(tmp_path):
+    path = tmp_path / "memory.events"
+    path.write_text("low 0\nhigh 12\nmax 3\noom 1\noom_kill 1\n")
+    assert cgroups.read_flat_keyed(path) == {
+        "low": 0,
+        "high": 12,
+        "max": 3,
+        "oom": 1,
+        "oom_kill": 1,
+    }
+
+
+async def test_inotify_watcher(tmp_path):
+    path = tmp_path / "memory.events"
+    path.write_text("oom_kill 0\n")
+    modified = asyncio.Event()
+
+    watcher = cgroups.InotifyWatcher()
+    try:
+        wd = watcher.watch(path, modified.set)
+        path.write_text("oom_kill 1\n")
+        await asyncio.wait_for(modified.wait(), 1)
+
+        watcher.unwatch(wd)
+        modified.clear()
+        path.write_text("oom_kill 2\n")
+        await asyncio.sleep(0.1)
+        assert not modified.is_set()
+    finally:
+        watcher.close()
+
+
+def test_read_pressure(tmp_path):
+    path = tmp_path / "memory.pressure"
+    path.write_text(
+        "some avg10=1.50 avg60=0.20 avg300=0.00 total=1234\n"
+        "full avg10=0.50 avg60=0.00 avg300=0.00 total=12\n"
+    )
+    pressure = cgroups.read_pressure(path)
+    assert pressure["some"]["avg10"] == 1.5
+    assert pressure["full"]["total"] == 12
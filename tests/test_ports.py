@@ -0,0 +1,68 @@
+import socket
+
+import pytest
+
+from systemdspawner import ports, systemd
+
+
+def test_allocate_range():
+    allocator = ports.PortAllocator()
+    with socket.socket() as s:
+        s.bind(("", 0))
+        s.listen()
+        used_port = s.getsockname()[1]
+        port_range = [used_port, used_port + 2]
+
+        # the port in use and reserved ports are skipped
+        allocated = [allocator.allocate(port_range) for i in range(2)]
+        assert allocated == [used_port + 1, used_port + 2]
+        with pytest.raises(RuntimeError):
+            allocator.allocate(port_range)
+
+        allocator.release(used_port + 1)
+        assert allocator.allocate(port_range) == used_port + 1
+
+
+def test_allocate_random(monkeypatch):
+    picked = iter([8000, 8000, 8001])
+    monkeypatch.setattr(ports, "random_port", lambda: next(picked))
+    allocator = ports.PortAllocator()
+    assert allocator.allocate() == 8000
+    # 8000 is picked again, but is reserved
+    assert allocator.allocate() == 8001
+
+
+def test_spawner_state(spawner):
+    spawner.port = ports.allocator.allocate()
+    state = spawner.get_state()
+    assert state["port"] == spawner.port
+
+    spawner.clear_state()
+    assert spawner.port == 0
+    assert state["port"] not in ports.allocator.reserved
+
+    spawner.load_state(state)
+    assert spawner.port in ports.allocator.reserved
+    spawner.clear_state()
+
+
+async def test_stop_releases_port_once(spawner, monkeypatch):
+    """
+    Test that clearing the state after stop() doesn't release the port again,
+    once reserved for another user server.
+    """
+
+    async def stop_service(unit_name):
+        pass
+
+    monkeypatch.setattr(systemd, "stop_service", stop_service)
+    monkeypatch.setattr(ports, "random_port", lambda: 8000)
+    spawner.port = ports.allocator.allocate()
+    await spawner.stop()
+    assert spawner.port == 0
+
+    other_port = ports.allocator.allocate()
+    assert other_port == 8000
+    spawner.clear_state()
+    assert other_port in ports.allocator.reserved
+    ports.allocator.release(other_port)
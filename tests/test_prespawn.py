@@ -0,0 +1,107 @@
+import asyncio
+from datetime import datetime, timedelta, timezone
+from types import SimpleNamespace
+
+from systemdspawner import prespawn
+
+
+def test_parse_calendar_elapse():
+    output = """
+  Original form: Mon *-*-* 10:00
+Normalized form: Mon *-*-* 10:00:00
+    Next elapse: Mon 2026-10-26 10:00:00 CET
+       (in UTC): Mon 2026-10-26 09:00:00 UTC
+       From now: 6 days left
+"""
+    expected = datetime(2026, 10, 26, 9, tzinfo=timezone.utc).timestamp()
+    assert prespawn.parse_calendar_elapse(output) == expected
+
+    utc_output = "    Next elapse: Mon 2026-10-26 09:00:00 UTC\n"
+    assert prespawn.parse_calendar_elapse(utc_output) == expected
+
+    assert prespawn.parse_calendar_elapse("    Next elapse: never\n") is None
+
+
+async def test_next_elapse_local_time(monkeypatch):
+    """
+    Test that calendars are evaluated in the local timezone, like timers, as
+    systemd-analyze inherits it.
+    """
+    output = b"""
+    Next elapse: Mon 2026-10-26 10:00:00 CET
+       (in UTC): Mon 2026-10-26 09:00:00 UTC
+"""
+    calls = []
+
+    async def communicate():
+        return output, None
+
+    async def create_subprocess_exec(*cmd, **kwargs):
+        calls.append((cmd, kwargs))
+        return SimpleNamespace(communicate=communicate, returncode=0)
+
+    monkeypatch.setattr(asyncio, "create_subprocess_exec", create_subprocess_exec)
+    elapse = await prespawn.next_elapse("Mon *-*-* 10:00")
+    assert elapse == datetime(2026, 10, 26, 9, tzinfo=timezone.utc).timestamp()
+    [(cmd, kwargs)] = calls
+    assert cmd == ("systemd-analyze", "calendar", "Mon *-*-* 10:00")
+    assert "env" not in kwargs
+
+
+class FakeHub:
+    """
+    Fake responses of the hub's REST API.
+    """
+
+    def __init__(self, servers):
+        self.servers = servers
+        self.requests = []
+
+    async def api_request(self, method, path, body=None):
+        self.requests.append((method, path, body))
+        if path == "/groups/course":
+            return {"users": list(self.servers)}
+        username = path.split("/")[2]
+        if method == "GET":
+            server = self.servers[username]
+            return {"servers": {"": server} if server else {}}
+
+
+def iso(dt):
+    return dt.isoformat().replace("+00:00", "Z")
+
+
+async def test_prespawn_collect(monkeypatch):
+    now = datetime.now(timezone.utc)
+    started = now - timedelta(minutes=20)
+    hub = FakeHub(
+        {
+            "running": {"started": iso(started), "last_activity": iso(started)},
+            "claimed": None,
+            "unclaimed": None,
+            "stopped": None,
+        }
+    )
+    prespawner = prespawn.PreSpawner("http://hub/api", "token", rate=1000)
+    monkeypatch.setattr(prespawner, "api_request", hub.api_request)
+    entry = {"group": "course", "calendar": "*-*-* 10:00"}
+
+    usernames = await prespawner.prespawn(entry)
+    assert usernames == ["claimed", "unclaimed", "stopped"]
+    assert ("POST", "/users/claimed/server", {"prespawned": True}) in hub.requests
+    assert ("POST", "/users/running/server", {"prespawned": True}) not in hub.requests
+
+    hub.servers["claimed"] = {
+        "started": iso(started),
+        "last_activity": iso(now - timedelta(minutes=5)),
+    }
+    hub.servers["unclaimed"] = {
+        "started": iso(started),
+        "last_activity": iso(started + timedelta(seconds=10)),
+    }
+    hub.requests.clear()
+    claimed, wasted_seconds = await prespawner.collect(entry, usernames)
+    assert claimed == 1
+    assert 1190 < wasted_seconds < 1210
+    deleted = [path for method, path, _ in hub.requests if method == "DELETE"]
+    assert deleted == ["/users/unclaimed/server"]
@@ -8,6 +8,8 @@ import os
 import tempfile
 import time
 
+import pytest
+
 from systemdspawner import systemd
 
 
@@ -22,6 +24,102 @@ def test_get_systemd_version():
     ), "Either systemd wasn't running, or we failed to parse the version into an integer!"
 
 
+def test_parse_properties():
+    output = "ActiveState=active\nSubState=running\nExecStart=a=b\n\n"
+    assert systemd.parse_properties(output) == {
+        "ActiveState": "active",
+        "SubState": "running",
+        "ExecStart": "a=b",
+    }
+
+
+async def test_run_systemd_command_timeout(monkeypatch):
+    """
+    Test that timed out commands are retried, and open the circuit breaker so
+    that further commands are rejected without being run.
+    """
+    monkeypatch.setattr(systemd, "breaker", systemd.CircuitBreaker(2, 30))
+    monkeypatch.setattr(systemd, "RETRY_BACKOFF", 0)
+
+    with pytest.raises(TimeoutError):
+        await systemd.run_systemd_command("test", ["sleep", "10"], 0.1, retries=1)
+    assert systemd.breaker.state == "open"
+
+    with pytest.raises(systemd.SystemdUnavailable):
+        await systemd.run_systemd_command("test", ["true"], 1)
+
+
+def test_circuit_breaker(monkeypatch):
+    breaker = systemd.CircuitBreaker(failure_threshold=1, reset_timeout=30)
+    assert breaker.allow()
+    breaker.record_failure()
+    assert not breaker.allow()
+
+    # after reset_timeout, a single trial call is let through, and its
+    # failure re-opens the breaker
+    breaker.opened_at -= 30
+    assert breaker.state == "half-open"
+    assert breaker.allow()
+    assert not breaker.allow()
+    breaker.record_failure()
+    assert breaker.state == "open"
+    assert not breaker.allow()
+
+    # a trial call not completing is replaced after reset_timeout
+    breaker.opened_at -= 30
+    assert breaker.allow()
+    assert not breaker.allow()
+    breaker.trial_started -= 30
+    assert breaker.allow()
+
+    # the trial call's success closes the breaker
+    breaker.record_success()
+    assert breaker.state == "closed"
+    assert breaker.allow()
+    assert breaker.allow()
+
+
+async def test_circuit_breaker_trial_not_run(tmp_path, monkeypatch):
+    breaker = systemd.CircuitBreaker(failure_threshold=1, reset_timeout=30)
+    monkeypatch.setattr(systemd, "breaker", breaker)
+    breaker.record_failure()
+    breaker.opened_at -= 30
+
+    # a trial call whose command can't be run doesn't hold up the next one
+    with pytest.raises(OSError):
+        await systemd.run_systemd_command(
+            "test", [str(tmp_path / "missing")], timeout=5
+        )
+    assert breaker.state == "half-open"
+    returncode, _ = await systemd.run_systemd_command("test", ["true"], timeout=5)
+    assert returncode == 0
+    assert breaker.state == "closed"
+
+
+FAKE_JOURNALCTL = """#!/bin/sh
+echo "$@" > "$(dirname "$0")/args"
+printf '%s\\n' '{"__CURSOR": "s=1", "MESSAGE": "hello"}'
+printf '%s\\n' '{"__CURSOR": "s=2", "MESSAGE": [255, 0]}'
+printf '%s\\n' '{"__CURSOR": "s=3", "MESSAGE": "h\\u00e9llo"}'
+"""
+
+
+async def test_count_journal_entries(tmp_path, monkeypatch):
+    journalctl = tmp_path / "journalctl"
+    journalctl.write_text(FAKE_JOURNALCTL)
+    journalctl.chmod(0o755)
+    monkeypatch.setenv("PATH", f"{tmp_path}:{os.environ['PATH']}")
+
+    counted = await systemd.count_journal_entries("jupyter", after_cursor="s=0")
+    assert counted == (3, 5 + 2 + 6, "s=3")
+    args = (tmp_path / "args").read_text().split()
+    assert "--namespace=jupyter" in args
+    assert "--after-cursor=s=0" in args
+
+    await systemd.count_journal_entries("jupyter", since=1700000000.5)
+    assert "--since=@1700000000" in (tmp_path / "args").read_text().split()
+
+
 async def test_simple_start():
     unit_name = "systemdspawner-unittest-" + str(time.time())
     await systemd.start_transient_service(
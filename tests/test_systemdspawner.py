@@ -1,9 +1,18 @@
+import asyncio
+import os
+import shutil
+import subprocess
+import time
+from datetime import datetime, timedelta, timezone
+from types import SimpleNamespace
+
+import pytest
 from jupyterhub.tests.mocking import public_url
 from jupyterhub.tests.test_api import add_user, api_request
 from jupyterhub.utils import url_path_join
 from tornado.httpclient import AsyncHTTPClient
 
-from systemdspawner import systemd
+from systemdspawner import cgroups, systemd, systemdspawner
 
 
 async def test_start_stop(hub_app, systemdspawner_config, pytestconfig):
@@ -68,3 +77,584 @@ async def test_start_stop(hub_app, systemdspawner_config, pytestconfig):
 
     # verify the server is stopped via systemctl
     assert not await systemd.service_running(unit_name)
+
+
+async def test_progress(spawner, monkeypatch):
+    """
+    Test that progress() maps unit states and server log lines to increasing
+    progress events, and stops following the journal once the server runs.
+    """
+    journal_closed = False
+
+    async def follow_journal(unit_name, since=None, idle_timeout=None, namespace=None):
+        nonlocal journal_closed
+        try:
+            yield None
+            yield "Starting jupyterhub single-user server extension version 5.0.0"
+            yield "some chatty line"
+            yield "some chatty line"
+            yield "Jupyter Server 2.14.0 is running at:"
+            yield "a line that should never be read"
+        finally:
+            journal_closed = True
+
+    async def service_properties(unit_name, *names):
+        return {"ActiveState": "active"}
+
+    monkeypatch.setattr(systemd, "follow_journal", follow_journal)
+    monkeypatch.setattr(systemd, "service_properties", service_properties)
+
+    events = [event async for event in spawner.progress()]
+    assert [event["progress"] for event in events] == [
+        systemdspawner.UNIT_STATE_PROGRESS["active"][0],
+        50,
+        systemdspawner.SERVER_READY_PROGRESS,
+    ]
+    assert journal_closed
+
+
+async def test_progress_failed(spawner, monkeypatch):
+    """
+    Test that progress() stops with a message when the unit fails.
+    """
+
+    async def follow_journal(unit_name, since=None, idle_timeout=None, namespace=None):
+        while True:
+            yield None
+
+    async def service_properties(unit_name, *names):
+        return {"ActiveState": "failed"}
+
+    monkeypatch.setattr(systemd, "follow_journal", follow_journal)
+    monkeypatch.setattr(systemd, "service_properties", service_properties)
+
+    events = [event async for event in spawner.progress()]
+    assert len(events) == 1
+    assert "failed" in events[0]["message"]
+
+
+async def test_progress_zygote_scope(spawner, monkeypatch):
+    """
+    Test that progress() follows the journal of the scope once start() has
+    decided to start the server from the zygote.
+    """
+    followed_units = []
+
+    async def follow_journal(unit_name, since=None, idle_timeout=None, namespace=None):
+        followed_units.append(unit_name)
+        yield None
+        spawner.zygote_scope = True
+        yield None
+        yield "Jupyter Server 2.14.0 is running at:"
+
+    async def service_properties(unit_name, *names):
+        return {"ActiveState": "active"}
+
+    monkeypatch.setattr(systemd, "follow_journal", follow_journal)
+    monkeypatch.setattr(systemd, "service_properties", service_properties)
+
+    events = [event async for event in spawner.progress()]
+    assert events[-1]["progress"] == systemdspawner.SERVER_READY_PROGRESS
+    assert followed_units == [spawner.unit_name, f"{spawner.unit_name}.scope"]
+
+
+async def test_measure_ready(spawner):
+    """
+    Test that the time until a started server responds is recorded.
+    """
+    from prometheus_client import REGISTRY
+
+    async def respond(reader, writer):
+        await reader.readuntil(b"\r\n\r\n")
+        writer.write(b"HTTP/1.1 404 Not Found\r\nContent-Length: 0\r\n\r\n")
+        await writer.drain()
+        writer.close()
+
+    server = await asyncio.start_server(respond, "127.0.0.1", 0)
+    port = server.sockets[0].getsockname()[1]
+    sample = ("systemdspawner_server_ready_duration_seconds_count", {"mode": "service"})
+    count = REGISTRY.get_sample_value(*sample) or 0
+
+    await spawner._measure_ready("127.0.0.1", port, time.time())
+    server.close()
+    assert REGISTRY.get_sample_value(*sample) == count + 1
+
+
+async def test_progress_log_namespace(spawner, monkeypatch):
+    """
+    Test that progress() follows the journal in the unit's log namespace,
+    even before start() has set it.
+    """
+    followed_namespaces = []
+
+    async def follow_journal(unit_name, since=None, idle_timeout=None, namespace=None):
+        followed_namespaces.append(namespace)
+        yield None
+
+    async def service_properties(unit_name, *names):
+        return {"ActiveState": "failed"}
+
+    async def get_capabilities():
+        return {"systemd_version": 252}
+
+    monkeypatch.setattr(systemd, "follow_journal", follow_journal)
+    monkeypatch.setattr(systemd, "service_properties", service_properties)
+    monkeypatch.setattr(spawner, "_get_capabilities", get_capabilities)
+    spawner.log_namespace = "jupyter-{USERNAME}"
+
+    [event async for event in spawner.progress()]
+    assert followed_namespaces == ["jupyter-testuser"]
+
+
+async def test_progress_after_stop(spawner, monkeypatch):
+    """
+    Test that progress() of the next spawn doesn't follow the journal from the
+    start of a previous spawn, as the spawner is reused.
+    """
+    followed_since = []
+
+    async def follow_journal(unit_name, since=None, idle_timeout=None, namespace=None):
+        followed_since.append(since)
+        yield None
+
+    async def service_properties(unit_name, *names):
+        return {"ActiveState": "failed"}
+
+    async def stop_service(unit_name):
+        pass
+
+    monkeypatch.setattr(systemd, "follow_journal", follow_journal)
+    monkeypatch.setattr(systemd, "service_properties", service_properties)
+    monkeypatch.setattr(systemd, "stop_service", stop_service)
+
+    spawner._start_time = 1000
+    await spawner.stop()
+    spawner.clear_state()
+    [event async for event in spawner.progress()]
+    # None follows the journal from now
+    assert followed_since == [None]
+
+
+def test_environment_profile_properties(spawner):
+    """
+    Test that environment profiles are mounted read-only into units, if
+    supported by systemd.
+    """
+    caps = {"systemd_version": 252}
+    properties = spawner._environment_profile_properties(
+        {
+            "path": "/opt/envs/{USERNAME}",
+            "extension_images": ["/var/lib/envs/tools.raw"],
+        },
+        caps,
+    )
+    assert properties == {
+        "BindReadOnlyPaths": ["/opt/envs/testuser"],
+        "ExtensionImages": ["/var/lib/envs/tools.raw"],
+    }
+
+    image_profile = {
+        "image": "/var/lib/envs/ds.squashfs",
+        "mount_point": "/opt/envs/ds",
+    }
+    properties = spawner._environment_profile_properties(image_profile, caps)
+    assert properties == {
+        "MountImages": ["/var/lib/envs/ds.squashfs:/opt/envs/ds:ro"],
+    }
+
+    with pytest.raises(RuntimeError, match="with image require systemd version 247"):
+        spawner._environment_profile_properties(image_profile, {"systemd_version": 245})
+    with pytest.raises(RuntimeError, match="extension_images require .* 248"):
+        spawner._environment_profile_properties(
+            {"extension_images": ["/var/lib/envs/tools.raw"]}, {"systemd_version": 247}
+        )
+    # an unknown version isn't checked
+    assert spawner._environment_profile_properties(
+        image_profile, {"systemd_version": None}
+    )
+
+
+def test_environment_profile_state(spawner):
+    """
+    Test that the environment profile is recorded in and loaded from state.
+    """
+    assert "environment_profile" not in spawner.get_state()
+    spawner.load_state({"unit_name": "unit", "environment_profile": "ds"})
+    assert spawner.get_state()["environment_profile"] == "ds"
+
+
+def test_zygote_supported(spawner):
+    """
+    Test that only units with resource control properties are started from a
+    zygote.
+    """
+    assert spawner._zygote_supported(
+        {"MemoryMax": "1G", "CPUQuota": "100%", "NoNewPrivileges": "yes"}
+    )
+    assert not spawner._zygote_supported({"MemoryMax": "1G", "PrivateTmp": "yes"})
+
+
+def test_memory_events_changed(spawner, tmp_path):
+    """
+    Test that memory events are counted, and passed to memory_event_hook.
+    """
+    hook_events = []
+    spawner.memory_event_hook = lambda spawner, events: hook_events.append(events)
+
+    path = tmp_path / "memory.events"
+    spawner._memory_events_last = {"high": 5, "oom": 0, "oom_kill": 0}
+    path.write_text("high 5\noom 1\noom_kill 2\n")
+    spawner._memory_events_changed(path)
+    path.write_text("high 7\noom 1\noom_kill 2\n")
+    spawner._memory_events_changed(path)
+
+    assert hook_events == [{"oom": 1, "oom_kill": 2}, {"high": 2}]
+    assert spawner.get_state()["memory_events"] == {
+        "high": 2,
+        "oom": 1,
+        "oom_kill": 2,
+    }
+
+
+async def test_async_memory_event_hook(spawner, tmp_path, caplog):
+    """
+    Test that failures of an async memory_event_hook are logged.
+    """
+
+    async def memory_event_hook(spawner, events):
+        raise ValueError("hook failed")
+
+    spawner.memory_event_hook = memory_event_hook
+    path = tmp_path / "memory.events"
+    path.write_text("oom_kill 1\n")
+    spawner._memory_events_changed(path)
+
+    assert len(spawner._memory_event_hook_tasks) == 1
+    await asyncio.gather(*spawner._memory_event_hook_tasks, return_exceptions=True)
+    assert not spawner._memory_event_hook_tasks
+    assert "memory_event_hook failed" in caplog.text
+    assert "hook failed" in caplog.text
+
+
+def test_memory_properties(spawner):
+    """
+    Test that mem_limit and mem_guarantee map to tiered memory properties.
+    """
+    caps = {"systemd_version": 252}
+    spawner.mem_limit = "1G"
+    spawner.mem_guarantee = "512M"
+    assert spawner._memory_properties(caps) == {
+        "MemoryAccounting": "yes",
+        "MemoryMax": 1024**3,
+    }
+
+    spawner.memory_policy = "tiered"
+    spawner.memory_swap_max = 0
+    spawner.oomd_memory_pressure_limit = "60%"
+    assert spawner._memory_properties(caps) == {
+        "MemoryAccounting": "yes",
+        "MemoryHigh": 1024**3,
+        "MemoryMax": int(1.25 * 1024**3),
+        "MemoryLow": 512 * 1024**2,
+        "MemorySwapMax": 0,
+        "ManagedOOMMemoryPressure": "kill",
+        "ManagedOOMMemoryPressureLimit": "60%",
+    }
+
+    spawner.memory_guarantee_hard = True
+    caps = {"systemd_version": 245}
+    properties = spawner._memory_properties(caps)
+    assert properties["MemoryMin"] == 512 * 1024**2
+    assert "ManagedOOMMemoryPressure" not in properties
+
+
+async def test_wait_for_pressure(spawner, monkeypatch):
+    """
+    Test that spawns wait for pressure to drop below thresholds, and fail if
+    it doesn't within spawn_pressure_timeout.
+    """
+    monkeypatch.setattr(systemdspawner, "PRESSURE_CHECK_INTERVAL", 0.01)
+    spawner.spawn_pressure_thresholds = {"memory": 20}
+    pressures = [50, 30, 10]
+
+    async def read_pressure():
+        return {("node", "memory"): {"some": {"avg10": pressures.pop(0)}}}
+
+    monkeypatch.setattr(spawner, "read_pressure", read_pressure)
+    await spawner._wait_for_pressure()
+    assert pressures == []
+    assert spawner._pressure_message is None
+
+    pressures = [50] * 1000
+    spawner.spawn_pressure_timeout = 0
+    with pytest.raises(RuntimeError, match="node memory 50% > 20%"):
+        await spawner._wait_for_pressure()
+
+
+async def test_read_pressure(spawner):
+    snapshot = await spawner.read_pressure()
+    if os.path.exists("/proc/pressure/memory"):
+        assert "avg10" in snapshot[("node", "memory")]["some"]
+
+
+async def test_refresh_pressure(spawner, monkeypatch):
+    """
+    Test that pressure is read between spawns, at most every
+    PRESSURE_CHECK_INTERVAL seconds across spawners.
+    """
+    pressures = [10, 20]
+
+    def read_pressure(path):
+        return {"some": {"avg10": pressures[0]}}
+
+    async def get_capabilities():
+        return {"pressure": True}
+
+    monkeypatch.setattr(cgroups, "read_pressure", read_pressure)
+    monkeypatch.setattr(spawner, "_get_capabilities", get_capabilities)
+    monkeypatch.setattr(systemdspawner.SystemdSpawner, "_pressure_read_at", 0)
+    gauge = systemdspawner.PRESSURE.labels(scope="node", resource="cpu", kind="some")
+
+    await spawner._refresh_pressure()
+    assert gauge._value.get() == 10
+    pressures.pop(0)
+    await spawner._refresh_pressure()
+    assert gauge._value.get() == 10
+
+    monkeypatch.setattr(systemdspawner, "PRESSURE_CHECK_INTERVAL", 0)
+    await spawner._refresh_pressure()
+    assert gauge._value.get() == 20
+
+
+async def test_update_cpu_weight(spawner, monkeypatch):
+    """
+    Test that units get a CPUWeight from cpu_guarantee, and are given
+    cpu_batch_weight when inactive.
+    """
+    set_properties = []
+
+    async def set_service_properties(unit_name, properties):
+        set_properties.append(properties)
+
+    monkeypatch.setattr(systemd, "set_service_properties", set_service_properties)
+    spawner.cpu_policy = "weight"
+    spawner.cpu_guarantee = 0.5
+    spawner.cpu_batch_weight = 10
+    spawner._cpu_weight = 1000  # as if started with spawn_cpu_weight
+
+    # no recorded activity yet
+    await spawner._update_cpu_weight()
+    assert set_properties == [{"CPUWeight": 50}]
+
+    spawner.orm_spawner = SimpleNamespace(
+        server=None, last_activity=datetime.now(timezone.utc) - timedelta(hours=1)
+    )
+    await spawner._update_cpu_weight()
+    await spawner._update_cpu_weight()
+    assert set_properties == [{"CPUWeight": 50}, {"CPUWeight": 10}]
+
+
+async def test_spawn_cpu_weight_until_ready(spawner, monkeypatch):
+    """
+    Test that spawn_cpu_weight is kept until the started server responds.
+    """
+    set_properties = []
+
+    async def set_service_properties(unit_name, properties):
+        set_properties.append(properties)
+
+    monkeypatch.setattr(systemd, "set_service_properties", set_service_properties)
+    spawner.cpu_policy = "weight"
+    spawner.spawn_cpu_weight = 1000
+    spawner._cpu_weight = 1000
+
+    ready = asyncio.Event()
+
+    async def respond(reader, writer):
+        await reader.readuntil(b"\r\n\r\n")
+        await ready.wait()
+        writer.write(b"HTTP/1.1 200 OK\r\nContent-Length: 0\r\n\r\n")
+        await writer.drain()
+        writer.close()
+
+    server = await asyncio.start_server(respond, "127.0.0.1", 0)
+    port = server.sockets[0].getsockname()[1]
+    task = asyncio.ensure_future(spawner._measure_ready("127.0.0.1", port, time.time()))
+    await asyncio.sleep(0.5)
+    assert set_properties == []
+
+    ready.set()
+    await task
+    server.close()
+    assert set_properties == [{"CPUWeight": 100}]
+
+
+def test_log_properties(spawner):
+    spawner.log_namespace = "jupyter"
+    spawner.log_rate_limit_interval = "30s"
+    spawner.log_rate_limit_burst = 1000
+    spawner.log_level_max = "info"
+    assert spawner._log_properties({"systemd_version": 252}) == {
+        "LogNamespace": "jupyter",
+        "LogRateLimitIntervalSec": "30s",
+        "LogRateLimitBurst": 1000,
+        "LogLevelMax": "info",
+    }
+    assert spawner._log_properties({"systemd_version": 243}) == {
+        "LogLevelMax": "info",
+    }
+
+
+async def test_measure_log_namespace(spawner, monkeypatch):
+    """
+    Test that messages logged to a namespace are counted incrementally, from
+    the cursor of the last entry counted.
+    """
+    counts = [(3, 100, "s=3"), (0, 0, None), (2, 50, "s=5")]
+    requests = []
+
+    async def count_journal_entries(namespace, after_cursor=None, since=None):
+        requests.append((after_cursor, since))
+        return counts.pop(0)
+
+    monkeypatch.setattr(systemd, "count_journal_entries", count_journal_entries)
+    monkeypatch.setattr(systemdspawner, "LOG_NAMESPACE_MEASURE_INTERVAL", 0)
+    monkeypatch.setattr(spawner, "_log_namespace_positions", {})
+    spawner._log_namespace = "test-measure"
+    messages = systemdspawner.LOG_NAMESPACE_MESSAGES.labels(namespace="test-measure")
+    message_bytes = systemdspawner.LOG_NAMESPACE_MESSAGE_BYTES.labels(
+        namespace="test-measure"
+    )
+
+    # the first measurement only records where to count from
+    before = time.time()
+    spawner._measure_log_namespace()
+    assert requests == []
+    for i in range(3):
+        spawner._measure_log_namespace()
+        await asyncio.gather(*spawner._log_namespace_tasks)
+    assert requests[0][0] is None and requests[0][1] >= before
+    assert requests[1:] == [("s=3", None), ("s=3", None)]
+    assert messages._value.get() == 5
+    assert message_bytes._value.get() == 150
+
+
+@pytest.mark.parametrize("reflink_supported", [True, False])
+async def test_seed_home(spawner, monkeypatch, tmp_path, reflink_supported):
+    """
+    Test that homes are seeded before the server starts if a probe finds
+    reflinks supported, and otherwise with a copy in the background.
+    """
+    started = []
+
+    async def start_transient_service(unit_name, cmd, args, **kwargs):
+        started.append(cmd + args)
+
+    async def service_running(unit_name):
+        return False
+
+    async def service_failed(unit_name):
+        # the probe fails without filesystem support for reflinks
+        return (
+            not reflink_supported
+            and bool(started)
+            and "--reflink=always" in started[-1][2]
+        )
+
+    async def reset_service(unit_name):
+        pass
+
+    monkeypatch.setattr(systemd, "start_transient_service", start_transient_service)
+    monkeypatch.setattr(systemd, "service_running", service_running)
+    monkeypatch.setattr(systemd, "service_failed", service_failed)
+    monkeypatch.setattr(systemd, "reset_service", reset_service)
+    (tmp_path / "notebooks").mkdir()
+    (tmp_path / "notebooks" / "welcome.ipynb").write_text("{}")
+    spawner.home_template = str(tmp_path)
+
+    await spawner._seed_home()
+    probe, copy = started
+    assert probe[-2:] == [
+        str(tmp_path / "notebooks" / "welcome.ipynb"),
+        "/var/lib/testuser/.systemdspawner-reflink-probe",
+    ]
+    assert copy == spawner._home_seeding_command(str(tmp_path), "/var/lib/testuser/")
+    if reflink_supported:
+        assert spawner._home_seeding_task is None
+    else:
+        await spawner._home_seeding_task
+    assert spawner.get_state()["home_seeded"]
+
+
+FAILING_NO_CLOBBER_CP = """#!/bin/sh
+# cp of coreutils 9.3 and 9.4, which has --update=none, and whose --no-clobber
+# fails when skipping existing files
+for arg; do
+    shift
+    case $arg in
+    --no-clobber) failing=1; set -- "$@" "$arg" ;;
+    --update=none) set -- "$@" --no-clobber ;;
+    *) set -- "$@" "$arg" ;;
+    esac
+done
+{cp} "$@" || exit
+[ -z "$failing" ]
+"""
+
+
+@pytest.mark.parametrize("coreutils", ["installed", "9.3"])
+def test_home_seeding_commands(spawner, tmp_path, coreutils):
+    """
+    Test the commands seeding homes, that existing files are skipped without
+    failing, and that the reflink probe doesn't leave files behind whether or
+    not the filesystem supports reflinks.
+    """
+    env = dict(os.environ)
+    if coreutils != "installed":
+        bin_dir = tmp_path / "bin"
+        bin_dir.mkdir()
+        fake_cp = bin_dir / "cp"
+        fake_cp.write_text(FAILING_NO_CLOBBER_CP.format(cp=shutil.which("cp")))
+        fake_cp.chmod(0o755)
+        env["PATH"] = f"{bin_dir}:{env['PATH']}"
+
+    template = tmp_path / "template"
+    (template / "notebooks").mkdir(parents=True)
+    (template / "notebooks" / "welcome.ipynb").write_text("welcome")
+    (template / ".bashrc").write_text("template")
+    home = tmp_path / "home"
+    home.mkdir()
+    (home / ".bashrc").write_text("user's own")
+
+    probe_file = spawner._home_template_probe_file(str(template))
+    scratch = home / ".systemdspawner-reflink-probe"
+    subprocess.run(spawner._reflink_probe_command(probe_file, str(scratch)), env=env)
+    assert not scratch.exists()
+
+    command = spawner._home_seeding_command(str(template), f"{home}/")
+    subprocess.run(command, env=env, check=True)
+    assert (home / "notebooks" / "welcome.ipynb").read_text() == "welcome"
+    assert (home / ".bashrc").read_text() == "user's own"
+    assert sorted(p.name for p in home.iterdir()) == [".bashrc", "notebooks"]
+
+    # all files exist on a retry
+    subprocess.run(command, env=env, check=True)
+
+
+def test_io_properties(spawner, tmp_path):
+    spawner.io_read_bandwidth_max = "100M"
+    spawner.io_write_iops_max = 500
+    spawner.io_device_latency_target = "25ms"
+    caps = {"cgroup_version": 2, "cgroup_controllers": ["cpu", "io", "memory"]}
+
+    # the nearest existing parent of a working directory not yet created
+    working_dir = str(tmp_path / "home" / "testuser")
+    assert spawner._io_properties(caps, working_dir) == {
+        "IOAccounting": "yes",
+        "IOReadBandwidthMax": f"{tmp_path} 104857600",
+        "IOWriteIOPSMax": f"{tmp_path} 500",
+        "IODeviceLatencyTargetSec": f"{tmp_path} 25ms",
+    }
+
+    caps["cgroup_controllers"] = ["cpu", "memory"]
+    assert spawner._io_properties(caps, working_dir) == {}
@@ -0,0 +1,80 @@
+"""
+Test the zygote process, without moving its children into systemd scopes.
+"""
+import asyncio
+import os
+import sys
+
+import pytest
+
+from systemdspawner import zygote
+
+
+@pytest.fixture
+async def zygote_socket(tmp_path):
+    socket_path = str(tmp_path / "zygote.sock")
+    proc = await asyncio.create_subprocess_exec(
+        sys.executable, zygote.__file__, "--socket", socket_path, "--preload", "json"
+    )
+    for i in range(100):
+        try:
+            await zygote.zygote_request(socket_path, {"action": "ping"})
+            break
+        except OSError:
+            await asyncio.sleep(0.1)
+    yield socket_path
+    proc.terminate()
+    await proc.wait()
+
+
+async def test_fork_release(zygote_socket, tmp_path):
+    """
+    Test that a forked child only runs once released, as the requested user
+    in the requested working directory and environment.
+    """
+    response = await zygote.zygote_request(
+        zygote_socket,
+        {
+            "action": "fork",
+            "uid": os.getuid(),
+            "gid": os.getgid(),
+            "working_dir": str(tmp_path),
+            "env": {"TESTING_ZYGOTE_ENV": "TEST"},
+            "argv": ["/bin/sh", "-c", "echo $TESTING_ZYGOTE_ENV $(pwd) > out"],
+            "no_new_privileges": True,
+        },
+    )
+    await asyncio.sleep(0.2)
+    assert not (tmp_path / "out").exists()
+
+    await zygote.zygote_request(
+        zygote_socket, {"action": "release", "pid": response["pid"]}
+    )
+    for i in range(50):
+        if (tmp_path / "out").exists():
+            break
+        await asyncio.sleep(0.1)
+    assert (tmp_path / "out").read_text().strip() == f"TEST {tmp_path}"
+
+
+async def test_unknown_pid(zygote_socket):
+    with pytest.raises(RuntimeError):
+        await zygote.zygote_request(zygote_socket, {"action": "release", "pid": 1})
+
+
+def test_preloaded_for_env(monkeypatch):
+    """
+    Test that a preloaded jupyterhub.singleuser is only used for the server
+    application it was imported for.
+    """
+    env = {"JUPYTERHUB_SINGLEUSER_APP": "notebook.notebookapp.NotebookApp"}
+    monkeypatch.delenv("JUPYTERHUB_SINGLEUSER_APP", raising=False)
+    monkeypatch.delenv("JUPYTERHUB_SINGLEUSER_EXTENSION", raising=False)
+    monkeypatch.delitem(sys.modules, "jupyterhub.singleuser", raising=False)
+    assert zygote.preloaded_for_env(env)
+
+    monkeypatch.setitem(sys.modules, "jupyterhub.singleuser", object())
+    assert zygote.preloaded_for_env({})
+    assert not zygote.preloaded_for_env(env)
+    monkeypatch.setenv("JUPYTERHUB_SINGLEUSER_APP", env["JUPYTERHUB_SINGLEUSER_APP"])
+    assert zygote.preloaded_for_env(env)